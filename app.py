@@ -1,26 +1,436 @@
-from flask import Flask, render_template_string, request, jsonify, session, redirect, url_for, send_from_directory
+from flask import Flask, Request, request, jsonify, session, redirect, url_for, send_from_directory, send_file, abort, Response, stream_with_context, g
 import sqlite3
+import json
+import queue
+import threading
+import time
+import math
+import bisect
+import functools
+import cProfile
+import io
+import marshal
+import pstats
+import random
+import sys
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import hashlib
+import html
+import gzip
 import uuid
 import os
 import base64
-from datetime import datetime
+import mimetypes
+import re
+import tempfile
+from datetime import datetime, timedelta, timezone
 import secrets
+import socket
+from urllib.parse import urlparse
+from flask.sessions import SecureCookieSessionInterface
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.http import is_resource_modified
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+import imaging
+import passwords
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)
+# Shared by every worker so sessions verify wherever a request lands. When
+# unset, one kept in the database is loaded on first use (ensure_secret_key).
+app.secret_key = os.environ.get('CHAT_SECRET_KEY')
 
 # Configuration
-DATABASE = 'chatroom.db'
+DATABASE = os.environ.get('CHAT_DATABASE', 'chatroom.db')
 UPLOAD_FOLDER = 'uploads'
 MAX_IMAGE_SIZE = 1024 * 1024  # 1MB default
+MESSAGE_PAGE_SIZE = 50  # Messages returned on a full (re)load
+MAX_HISTORY_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+MAX_DELETIONS_PER_SYNC = 100  # Beyond this a client is told to reload
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600  # Images are content-addressed, so never change
+ASSET_CACHE_MAX_AGE = 365 * 24 * 3600  # Asset URLs carry a content hash
+STATIC_ASSETS = ['chat.css', 'chat.js']  # Served fingerprinted under /assets/
+IMAGE_MIGRATION_BATCH = 100
+UPLOAD_TMP_FOLDER = os.path.join(UPLOAD_FOLDER, 'tmp')  # Same filesystem, so files can be renamed into place
+MAX_FORM_OVERHEAD = 64 * 1024  # Allowance for text fields and multipart framing
+SNIFF_BYTES = 16  # Leading bytes needed to recognise an image format
+MAX_FORM_MEMORY = 1024 * 1024  # Bound on what the form parser buffers in memory
+VARIANT_FOLDER = os.path.join(UPLOAD_FOLDER, 'variants')
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))  # Processes rendering image variants
+
+# Downscaled copies made of every upload: name -> (max width, max height, quality)
+IMAGE_VARIANTS = {
+    'thumb': (240, 240, 75),
+    'display': (800, 600, 82),  # Feed images are shown at most 300px tall
+}
+STREAM_QUEUE_SIZE = 256  # Events buffered per streaming client before it is dropped
+STREAM_KEEPALIVE = 15  # Seconds between keepalive comments on an idle stream
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 16))  # Max open connections per process
+DB_POOL_TIMEOUT = 10  # Seconds to wait for a free connection
+WRITE_BATCH_SIZE = 64  # Max queued writes committed in one transaction
+WRITE_TIMEOUT = 30  # Seconds a request waits for its write to commit
+RECENT_CACHE_SIZE = int(os.environ.get('RECENT_CACHE_SIZE', 500))  # Messages kept in memory
+RESPONSE_CACHE_ENTRIES = 1024  # Distinct cursor pairs cached per room version
+COMPRESS_MIN_SIZE = 1024  # Smaller replies are sent uncompressed
+CHANGE_POLL_INTERVAL = 1.0  # Seconds between checks for writes by other processes
+BROKER_URL = os.environ.get('CHAT_BROKER', 'sqlite')  # 'local', 'sqlite' or a redis:// URL
+BROKER_POLL_INTERVAL = 0.05  # Seconds between data_version checks by the sqlite broker
+BROKER_CATCH_UP_BATCH = 500  # Rows read per query when catching up from the database
+BROKER_RECONNECT_DELAY = 1.0
+BROKER_PUBLISH_QUEUE = 1000  # Events waiting for Redis before new ones are dropped
+BROKER_CHANNEL = 'chat-events'
+
+# Admission control for /api/send_message. Token buckets refill steadily up
+# to their burst size; every message costs one message token and its request
+# size in upload tokens, so images weigh by size. An address gets
+# ADDRESS_LIMIT_FACTOR times a user's allowance, as users may share one.
+SEND_RATE = float(os.environ.get('CHAT_SEND_RATE', 1.0))  # Messages per second
+SEND_BURST = int(os.environ.get('CHAT_SEND_BURST', 10))
+UPLOAD_RATE = int(os.environ.get('CHAT_UPLOAD_RATE', 256 * 1024))  # Request bytes per second
+UPLOAD_BURST = int(os.environ.get('CHAT_UPLOAD_BURST', 4 * 1024 * 1024))
+ADDRESS_LIMIT_FACTOR = 5
+RATE_LIMIT_KEYS = 10000  # Buckets remembered; the longest idle are forgotten
+SHED_QUEUE_DEPTH = int(os.environ.get('CHAT_SHED_QUEUE_DEPTH', 500))  # Queued writes before shedding
+SHED_COMMIT_TIME = 0.5  # Average seconds per write batch, while writes queue, before shedding
+SHED_RETRY_AFTER = 1
+
+# Password hashing. The cost is recorded in each hash; hashes made with an
+# older scheme or cost are replaced when their owner next logs in.
+PASSWORD_SCHEME = os.environ.get('CHAT_PASSWORD_SCHEME', 'scrypt')  # 'scrypt' or 'pbkdf2_sha256'
+SCRYPT_COST = tuple(int(v) for v in os.environ.get('CHAT_SCRYPT_COST', '16384,8,1').split(','))  # n, r, p
+PBKDF2_ITERATIONS = int(os.environ.get('CHAT_PBKDF2_ITERATIONS', 600000))
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', max(1, (os.cpu_count() or 2) // 2)))  # Threads hashing at once
+PASSWORD_QUEUE_DEPTH = int(os.environ.get('CHAT_PASSWORD_QUEUE_DEPTH', 64))  # Hashes waiting before logins are refused
+PASSWORD_TIMEOUT = 30  # Seconds a request waits for its hash
+
+# Instrumentation exposed on /metrics. Scrapers without an admin session
+# authenticate with this bearer token.
+METRICS_TOKEN = os.environ.get('CHAT_METRICS_TOKEN')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5, 2)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Request profiling, switched on by admins through the profile_* settings
+PROFILE_HEADER = 'X-Profile'  # Carries a token from /api/admin/profiling
+PROFILE_TOKEN_MAX_AGE = 3600
+PROFILES_KEPT = 50  # Captured profiles kept in memory per process
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples of slow-capture requests
+PROFILE_SAMPLER_IDLE = 1.0  # Seconds with no request to sample before the sampler thread exits
+PROFILE_EXCLUDED_ENDPOINTS = {'stream_messages'}  # Long-lived by design
+RETENTION_INTERVAL = 60  # Seconds between retention passes
+RETENTION_CHUNK = 500  # Messages removed per write transaction
+RETENTION_VACUUM_PAGES = 1000  # Free pages returned to the filesystem after each chunk
+ARCHIVE_FOLDER = os.environ.get('CHAT_ARCHIVE_FOLDER', 'archive')
+PURGE_CHUNK = 1000  # Messages deleted per write transaction by admin purges
+PURGE_JOBS_KEPT = 50  # Finished purge jobs remembered for status queries
+
+# Typed settings stored in the settings table: key -> (type, default)
+SETTINGS_SCHEMA = {
+    'max_image_size': (int, MAX_IMAGE_SIZE),
+    'admin_password': (str, 'admin123'),
+    # Retention policy; 0 disables a limit
+    'retention_days': (int, 0),
+    'retention_max_messages': (int, 0),
+    'retention_max_bytes': (int, 0),  # Size of the live database file
+    'retention_archive': (int, 0),  # 1 copies removed messages into ARCHIVE_FOLDER
+    'profile_sample_rate': (float, 0.0),  # Fraction of requests run under cProfile
+    'profile_slow_ms': (int, 0),  # Stack-sample requests, keeping those slower than this; 0 is off
+}
+RETENTION_SETTINGS = ['retention_days', 'retention_max_messages', 'retention_max_bytes', 'retention_archive']
+
+# SQLite tuning, applied once to every new connection. Pick one with
+# CHAT_STORAGE_PROFILE; 'balanced' suits most deployments.
+STORAGE_PROFILES = {
+    # WAL lets readers run alongside the writer; NORMAL only risks the last
+    # transactions on power loss, never corruption
+    'balanced': [
+        ('auto_vacuum', 'INCREMENTAL'),  # New files only, see 'flask vacuum'; must precede journal_mode
+        ('busy_timeout', 5000),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -64000),  # 64MB
+        ('mmap_size', 256 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+    ],
+    # Fsync on every commit
+    'durable': [
+        ('auto_vacuum', 'INCREMENTAL'),
+        ('busy_timeout', 5000),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'FULL'),
+        ('cache_size', -64000),
+        ('temp_store', 'MEMORY'),
+    ],
+    # The original rollback-journal behaviour
+    'legacy': [
+        ('busy_timeout', 5000),
+        ('journal_mode', 'DELETE'),
+        ('synchronous', 'FULL'),
+    ],
+}
+STORAGE_PROFILE = os.environ.get('CHAT_STORAGE_PROFILE', 'balanced')
+SQLITE_PRAGMAS = STORAGE_PROFILES[STORAGE_PROFILE]
 
 # Ensure upload directory exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(UPLOAD_TMP_FOLDER, exist_ok=True)
+
+IMAGE_KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Magic byte prefixes of the image formats we accept
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+]
+
+def sniff_image_type(data):
+    """Return the image MIME type from the leading bytes of a file, or None"""
+    for signature, content_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def image_path(key):
+    """Path of a stored image, fanned out by hash prefix (uploads/ab/cd/abcd...)"""
+    return os.path.join(UPLOAD_FOLDER, key[:2], key[2:4], key)
+
+def save_image_file(data):
+    """Write image bytes to the blob store and return their content hash key.
+
+    Identical images are stored once; the file is written to a temporary name
+    and renamed into place so readers never see a partial file.
+    """
+    key = hashlib.sha256(data).hexdigest()
+    if not os.path.exists(image_path(key)):
+        fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_TMP_FOLDER)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        place_image_file(tmp_path, key)
+    return key
+
+def place_image_file(tmp_path, key):
+    """Move a fully written temporary file to its content-addressed path"""
+    path = image_path(key)
+    if os.path.exists(path):
+        os.unlink(tmp_path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+
+class UploadSink:
+    """File-like object the form parser streams an uploaded image into.
+
+    Each chunk is size-checked, hashed and written straight to a temporary
+    file in the blob store, so memory use does not depend on the file size.
+    The leading bytes are kept to check the image type as soon as they
+    arrive.
+    """
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.head = b''
+        self.key = None
+        self._hash = hashlib.sha256()
+        fd, self.path = tempfile.mkstemp(dir=UPLOAD_TMP_FOLDER)
+        self._file = os.fdopen(fd, 'w+b')
+    
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise RequestEntityTooLarge()
+        if len(self.head) < SNIFF_BYTES:
+            self.head += data[:SNIFF_BYTES - len(self.head)]
+            if len(self.head) == SNIFF_BYTES and sniff_image_type(self.head) is None:
+                raise UnsupportedMediaType()
+        self._hash.update(data)
+        self._file.write(data)
+    
+    # Read side of the file interface, used by FileStorage
+    def read(self, *args):
+        return self._file.read(*args)
+    
+    def readline(self, *args):
+        return self._file.readline(*args)
+    
+    def seek(self, *args):
+        return self._file.seek(*args)
+    
+    def tell(self):
+        return self._file.tell()
+    
+    def content_type(self):
+        return sniff_image_type(self.head)
+    
+    def commit(self):
+        """Move the upload into the blob store and return its key"""
+        self._file.close()
+        self.key = self._hash.hexdigest()
+        place_image_file(self.path, self.key)
+        return self.key
+    
+    def discard(self):
+        if self.key is None:
+            self._file.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+def max_request_size():
+    """Largest request body accepted: an image at the size limit plus form fields"""
+    return get_setting('max_image_size') + MAX_FORM_OVERHEAD
+
+class ChatRequest(Request):
+    """Request that streams file uploads into the blob store"""
+    
+    max_form_memory_size = MAX_FORM_MEMORY
+    
+    @property
+    def max_content_length(self):
+        # Only message sends carry uploads; the image size setting cannot
+        # lock anyone out of logging in or changing it back
+        if self.endpoint == 'send_message':
+            return max_request_size()
+        return MAX_FORM_OVERHEAD
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        sink = UploadSink(get_setting('max_image_size'))
+        self.upload_sinks = getattr(self, 'upload_sinks', []) + [sink]
+        return sink
+
+app.request_class = ChatRequest
+
+@app.teardown_request
+def discard_uploads(exception):
+    # Removes temporary files of uploads that were rejected or never used
+    for sink in getattr(request, 'upload_sinks', []):
+        sink.discard()
+
+def variant_dir(key):
+    return os.path.join(VARIANT_FOLDER, key[:2])
+
+class VariantGenerator:
+    """Renders IMAGE_VARIANTS of new uploads in a pool of worker processes.
+
+    Decoding and resizing are CPU-bound, so they run outside the web
+    process; the request that uploaded the image does not wait for them.
+    Until a variant exists, its URL serves the original image.
+    """
+    
+    def __init__(self, workers=IMAGE_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+    
+    def job(self, key):
+        """The function and arguments that render one image's variants"""
+        return (imaging.generate_variants, os.path.abspath(image_path(key)),
+                os.path.abspath(variant_dir(key)), key, IMAGE_VARIANTS)
+    
+    def submit(self, key):
+        """Queue an image for rendering unless it already has variants"""
+        if not imaging.variants_supported():
+            return
+        ext = imaging.output_format()[2]
+        if os.path.exists(os.path.join(variant_dir(key), f'{key}.thumb{ext}')):
+            return
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if self._pool is None:
+                # Spawned workers run imaging, and also re-run the main
+                # module as __mp_main__: this file when started as
+                # `python app.py`. That repeats only its module-level setup,
+                # which opens no connections and starts no threads.
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            pool = self._pool
+        try:
+            future = pool.submit(*self.job(key))
+        except BrokenProcessPool:
+            self._failed(key, pool, broken=True)
+        except Exception:
+            self._failed(key, pool)
+        else:
+            future.add_done_callback(lambda future: self._done(key, pool, future))
+    
+    def _failed(self, key, pool, broken=False):
+        """Log a failed render; a broken pool is replaced on the next submit"""
+        app.logger.exception('Rendering variants of image %s failed', key)
+        with self._lock:
+            self._pending.discard(key)
+            self.failed += 1
+            if broken and self._pool is pool:
+                self._pool = None
+        if broken:
+            pool.shutdown(wait=False)
+    
+    def _done(self, key, pool, future):
+        try:
+            results = future.result()
+        except BrokenProcessPool:
+            self._failed(key, pool, broken=True)
+            return
+        except Exception:
+            self._failed(key, pool)
+            return
+        with self._lock:
+            self._pending.discard(key)
+        self.completed += 1
+        db_writer.submit(lambda conn: self._insert(conn, key, results))
+    
+    def record(self, key, results):
+        """Store rendered variants and wait for the commit"""
+        db_writer.run(lambda conn: self._insert(conn, key, results))
+    
+    def _insert(self, conn, key, results):
+        for name, path, content_type, width, height, size in results:
+            conn.execute('''
+                INSERT OR REPLACE INTO image_variants (image_key, variant, filename, content_type, width, height, size)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (key, name, os.path.basename(path), content_type, width, height, size))
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': imaging.variants_supported(),
+                'pending': len(self._pending),
+                'completed': self.completed,
+                'failed': self.failed
+            }
+
+image_variants = VariantGenerator()
+
+def record_image(conn, key, content_type, size):
+    """Register a stored image file in the images table"""
+    conn.execute('INSERT OR IGNORE INTO images (key, content_type, size) VALUES (?, ?, ?)',
+                 (key, content_type, size))
 
 def init_db():
     """Initialize the database with required tables"""
-    conn = sqlite3.connect(DATABASE)
+    conn = open_connection(DATABASE)
     cursor = conn.cursor()
     
     # Users table
@@ -51,6 +461,18 @@ def init_db():
         )
     ''')
     
+    # Message deletions, so clients syncing by cursor can drop removed messages.
+    # scope is 'all' (target NULL), 'user' (target = username), 'before'
+    # (target = last id removed) or 'user_before' (target = 'id:username')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_deletions (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT NOT NULL,
+            target TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
     # Settings table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS settings (
@@ -63,830 +485,2076 @@ def init_db():
     cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('max_image_size', str(MAX_IMAGE_SIZE)))
     cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('admin_password', 'admin123'))
     
+    # Session signing key, created once and shared by all worker processes
+    cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('secret_key', secrets.token_hex(32)))
+    
     # Create default admin user
-    admin_hash = hashlib.sha256('admin123'.encode()).hexdigest()
+    admin_hash = hash_password('admin123')
     cursor.execute('INSERT OR IGNORE INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)', ('admin', admin_hash, 1))
     
     conn.commit()
+    apply_migrations(conn)
     conn.close()
+    
+    # The move out of image_data scans messages, so it runs until it has once found nothing
+    with db_pool.connection() as conn:
+        images_migrated = conn.execute(SETTING_SQL, ('images_migrated',)).fetchone()
+    if not images_migrated:
+        migrate_image_data()
+    settings.get('max_image_size')  # Load the settings cache
 
-def get_db_connection():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Schema migrations, applied in order on top of the tables created above.
+# PRAGMA user_version records how many have been applied.
+MIGRATIONS = [
+    # 1: images move out of messages.image_data into the blob store
+    '''
+    ALTER TABLE messages ADD COLUMN image_key TEXT;
+    CREATE TABLE IF NOT EXISTS images (
+        key TEXT PRIMARY KEY,
+        content_type TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ''',
+    # 2: per-user message lookups (admin user deletion). The timeline itself
+    # is read in id order straight off the messages rowid b-tree.
+    '''
+    CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id, id);
+    ''',
+    # 3: downscaled copies of images, made in the background
+    '''
+    CREATE TABLE IF NOT EXISTS image_variants (
+        image_key TEXT NOT NULL,
+        variant TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        content_type TEXT NOT NULL,
+        width INTEGER NOT NULL,
+        height INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        PRIMARY KEY (image_key, variant)
+    );
+    ''',
+    # 4: full-text index over message content for moderator search. It stores
+    # no text of its own (content='messages') and is kept current by triggers.
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    );
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+    INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+    ''',
+    # 5: finding where the retention age cutoff falls
+    '''
+    CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp);
+    ''',
+]
 
-def hash_password(password):
-    """Hash password using SHA256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+# Queries on the hot request paths, kept together so check_query_plans() can
+# confirm each one is answered from an index
+TIMELINE_LATEST_SQL = 'SELECT * FROM messages ORDER BY id DESC LIMIT ?'
+HISTORY_SQL = 'SELECT * FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?'
+MESSAGE_BY_ID_SQL = 'SELECT * FROM messages WHERE id = ?'
+LATEST_DELETION_SQL = 'SELECT COALESCE(MAX(seq), 0) FROM message_deletions'
+DELETE_USER_MESSAGES_SQL = 'DELETE FROM messages WHERE user_id = ?'
+USER_BY_NAME_SQL = 'SELECT * FROM users WHERE username = ?'
+USER_BY_ID_SQL = 'SELECT username FROM users WHERE id = ?'
+USERS_LIST_SQL = 'SELECT id, username, email, created_at, is_banned, is_admin FROM users ORDER BY id DESC'
+SETTING_SQL = 'SELECT value FROM settings WHERE key = ?'
+USER_STATES_SQL = 'SELECT id, is_banned, is_admin FROM users'
+USER_STATES_AFTER_SQL = 'SELECT id, is_banned, is_admin FROM users WHERE id > ?'
+USER_SEQUENCE_SQL = "SELECT seq FROM sqlite_sequence WHERE name = 'users'"
+IMAGE_SQL = 'SELECT content_type FROM images WHERE key = ?'
+IMAGE_VARIANT_SQL = 'SELECT filename, content_type FROM image_variants WHERE image_key = ? AND variant = ?'
+RETENTION_AGE_SQL = 'SELECT id FROM messages WHERE timestamp < ? ORDER BY timestamp DESC LIMIT 1'
+RETENTION_COUNT_SQL = 'SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?'
+RETENTION_CHUNK_SQL = 'SELECT * FROM messages WHERE id <= ? ORDER BY id LIMIT ?'
+DELETE_BEFORE_SQL = 'DELETE FROM messages WHERE id <= ?'
+LATEST_MESSAGE_ID_SQL = 'SELECT COALESCE(MAX(id), 0) FROM messages'
+MESSAGES_AFTER_SQL = 'SELECT * FROM messages WHERE id > ? AND id < ? ORDER BY id LIMIT ?'
+DELETIONS_AFTER_SQL = 'SELECT seq, scope, target FROM message_deletions WHERE seq > ? AND seq < ? ORDER BY seq LIMIT ?'
+PURGE_CHUNK_END_SQL = 'SELECT id FROM messages WHERE id <= ? ORDER BY id LIMIT 1 OFFSET ?'
+PURGE_USER_CHUNK_END_SQL = 'SELECT id FROM messages WHERE user_id = ? ORDER BY id LIMIT 1 OFFSET ?'
+DELETE_USER_BEFORE_SQL = 'DELETE FROM messages WHERE user_id = ? AND id <= ?'
 
-def get_setting(key):
-    """Get setting value from database"""
-    conn = get_db_connection()
-    result = conn.execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
-    conn.close()
-    return result['value'] if result else None
+# (sql, sample parameters, whether walking a whole index in order is expected)
+HOT_QUERIES = [
+    (TIMELINE_LATEST_SQL, (MESSAGE_PAGE_SIZE,), True),  # reverse rowid walk, stops at LIMIT
+    (HISTORY_SQL, (1000, MESSAGE_PAGE_SIZE), False),
+    (MESSAGE_BY_ID_SQL, (1,), False),
+    (LATEST_DELETION_SQL, (), False),
+    (DELETE_USER_MESSAGES_SQL, (0,), False),
+    (USER_BY_NAME_SQL, ('admin',), False),
+    (USER_BY_ID_SQL, (1,), False),
+    (USERS_LIST_SQL, (), True),  # the admin user list shows everyone
+    (SETTING_SQL, ('max_image_size',), False),
+    (USER_STATES_AFTER_SQL, (1000,), False),
+    (IMAGE_SQL, ('0' * 64,), False),
+    (IMAGE_VARIANT_SQL, ('0' * 64, 'thumb'), False),
+    (RETENTION_AGE_SQL, ('2000-01-01 00:00:00',), False),
+    (RETENTION_COUNT_SQL, (1000,), True),  # reverse rowid walk, stops after OFFSET rows
+    (RETENTION_CHUNK_SQL, (1000, RETENTION_CHUNK), False),
+    (DELETE_BEFORE_SQL, (1000,), False),
+    (LATEST_MESSAGE_ID_SQL, (), False),
+    (MESSAGES_AFTER_SQL, (1000, 2000, BROKER_CATCH_UP_BATCH), False),
+    (DELETIONS_AFTER_SQL, (10, 20, BROKER_CATCH_UP_BATCH), False),
+    (PURGE_CHUNK_END_SQL, (1000, PURGE_CHUNK - 1), False),
+    (PURGE_USER_CHUNK_END_SQL, (0, PURGE_CHUNK - 1), False),
+    (DELETE_USER_BEFORE_SQL, (0, 1000), False),
+]
 
-def update_setting(key, value):
-    """Update setting in database"""
-    conn = get_db_connection()
-    conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
-    conn.commit()
+def check_query_plans(conn):
+    """Return (sql, plan step) pairs for hot queries that scan or sort a table"""
+    problems = []
+    for sql, params, ordered_scan in HOT_QUERIES:
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[3]
+            if 'TEMP B-TREE' in detail:
+                problems.append((sql, detail))
+            elif detail.startswith('SCAN') and not ordered_scan:
+                problems.append((sql, detail))
+    return problems
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a hot query would scan or sort a table instead of using an index."""
+    init_db()
+    conn = open_connection(DATABASE)
+    problems = check_query_plans(conn)
     conn.close()
+    for sql, detail in problems:
+        print(f'{detail}: {sql}')
+    if problems:
+        raise SystemExit(1)
+    print(f'All {len(HOT_QUERIES)} hot queries use an index')
 
-# HTML Template
-HTML_TEMPLATE = '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Chatroom</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #000000 0%, #1a1a1a 50%, #000000 100%);
-            height: 100vh;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-        }
-        
-        .container {
-            background: white;
-            border-radius: 15px;
-            box-shadow: 0 20px 40px rgba(0, 255, 0, 0.3);
-            width: 100%;
-            max-width: 800px;
-            height: 90vh;
-            display: flex;
-            flex-direction: column;
-            overflow: hidden;
-            border: 2px solid #00ff00;
-        }
-        
-        .header {
-            background: linear-gradient(135deg, #000000 0%, #1a1a1a 50%, #000000 100%);
-            color: #00ff00;
-            padding: 20px;
-            text-align: center;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-            border-bottom: 2px solid #00ff00;
-        }
-        
-        .user-info {
-            display: flex;
-            align-items: center;
-            gap: 15px;
-        }
-        
-        .logout-btn, .admin-btn {
-            background: rgba(0, 255, 0, 0.2);
-            border: 2px solid #00ff00;
-            color: #00ff00;
-            padding: 8px 15px;
-            border-radius: 20px;
-            cursor: pointer;
-            transition: all 0.3s;
-        }
-        
-        .logout-btn:hover, .admin-btn:hover {
-            background: #00ff00;
-            color: #000000;
-            box-shadow: 0 0 10px #00ff00;
-        }
-        
-        .messages {
-            flex: 1;
-            overflow-y: auto;
-            padding: 20px;
-            background: #f8f9fa;
-        }
-        
-        .message {
-            margin-bottom: 15px;
-            padding: 15px;
-            border-radius: 10px;
-            background: white;
-            box-shadow: 0 2px 5px rgba(0, 255, 0, 0.1);
-            animation: fadeIn 0.3s ease-in;
-            border-left: 4px solid #00ff00;
-        }
-        
-        @keyframes fadeIn {
-            from { opacity: 0; transform: translateY(10px); }
-            to { opacity: 1; transform: translateY(0); }
-        }
-        
-        .message-header {
-            display: flex;
-            justify-content: space-between;
-            margin-bottom: 8px;
-            font-size: 12px;
-            color: #666;
-        }
-        
-        .username {
-            font-weight: bold;
-            color: #00ff00;
-        }
-        
-        .message-content {
-            line-height: 1.4;
-        }
-        
-        .message-image {
-            max-width: 100%;
-            max-height: 300px;
-            border-radius: 8px;
-            margin-top: 10px;
-        }
-        
-        .message-url {
-            color: #00ff00;
-            text-decoration: none;
-            margin-top: 10px;
-            display: block;
-        }
-        
-        .message-url:hover {
-            text-decoration: underline;
-            text-shadow: 0 0 5px #00ff00;
-        }
-        
-        .input-area {
-            padding: 20px;
-            border-top: 2px solid #00ff00;
-            background: white;
-        }
-        
-        .message-type-selector {
-            display: flex;
-            gap: 10px;
-            margin-bottom: 15px;
-        }
-        
-        .type-btn {
-            padding: 8px 15px;
-            border: 2px solid #00ff00;
-            background: white;
-            color: #00ff00;
-            border-radius: 20px;
-            cursor: pointer;
-            transition: all 0.3s;
-        }
-        
-        .type-btn.active {
-            background: #00ff00;
-            color: #000000;
-            box-shadow: 0 0 10px #00ff00;
-        }
-        
-        .type-btn:hover {
-            box-shadow: 0 0 5px #00ff00;
-        }
-        
-        .input-group {
-            display: flex;
-            gap: 10px;
-            align-items: flex-end;
-        }
-        
-        .input-field {
-            flex: 1;
-            padding: 12px;
-            border: 2px solid #00ff00;
-            border-radius: 25px;
-            outline: none;
-            transition: border-color 0.3s;
-        }
-        
-        .input-field:focus {
-            border-color: #00ff00;
-            box-shadow: 0 0 10px rgba(0, 255, 0, 0.3);
-        }
-        
-        .file-input {
-            display: none;
-        }
-        
-        .file-btn, .send-btn {
-            background: #00ff00;
-            color: #000000;
-            border: 2px solid #00ff00;
-            padding: 12px 20px;
-            border-radius: 25px;
-            cursor: pointer;
-            transition: all 0.3s;
-            font-weight: bold;
-        }
-        
-        .file-btn:hover, .send-btn:hover {
-            background: #000000;
-            color: #00ff00;
-            box-shadow: 0 0 15px #00ff00;
-            transform: translateY(-2px);
-        }
-        
-        .login-form, .register-form, .admin-panel {
-            max-width: 400px;
-            margin: 0 auto;
-            padding: 40px;
-            background: white;
-            border-radius: 15px;
-            box-shadow: 0 20px 40px rgba(0, 255, 0, 0.3);
-            border: 2px solid #00ff00;
-        }
-        
-        .form-group {
-            margin-bottom: 20px;
-        }
-        
-        .form-group label {
-            display: block;
-            margin-bottom: 5px;
-            font-weight: bold;
-            color: #333;
-        }
-        
-        .form-group input {
-            width: 100%;
-            padding: 12px;
-            border: 2px solid #00ff00;
-            border-radius: 8px;
-            outline: none;
-            transition: border-color 0.3s;
-        }
-        
-        .form-group input:focus {
-            border-color: #00ff00;
-            box-shadow: 0 0 10px rgba(0, 255, 0, 0.3);
-        }
-        
-        .btn-primary {
-            width: 100%;
-            background: #00ff00;
-            color: #000000;
-            border: 2px solid #00ff00;
-            padding: 12px;
-            border-radius: 8px;
-            cursor: pointer;
-            font-size: 16px;
-            font-weight: bold;
-            transition: all 0.3s;
-        }
-        
-        .btn-primary:hover {
-            background: #000000;
-            color: #00ff00;
-            box-shadow: 0 0 15px #00ff00;
-        }
-        
-        .switch-form {
-            text-align: center;
-            margin-top: 20px;
-        }
-        
-        .switch-form a {
-            color: #00ff00;
-            text-decoration: none;
-            transition: all 0.3s;
-        }
-        
-        .switch-form a:hover {
-            text-shadow: 0 0 5px #00ff00;
-        }
-        
-        .admin-section {
-            margin: 20px 0;
-            padding: 20px;
-            border: 2px solid #00ff00;
-            border-radius: 8px;
-            background: rgba(0, 255, 0, 0.05);
-        }
-        
-        .admin-section h3 {
-            margin-bottom: 15px;
-            color: #333;
-        }
-        
-        .user-list {
-            max-height: 200px;
-            overflow-y: auto;
-        }
-        
-        .user-item {
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-            padding: 10px;
-            border-bottom: 1px solid #00ff00;
-        }
-        
-        .user-actions button {
-            margin-left: 5px;
-            padding: 5px 10px;
-            border: 2px solid;
-            border-radius: 4px;
-            cursor: pointer;
-            transition: all 0.3s;
-        }
-        
-        .btn-danger {
-            background: #ff0000;
-            color: white;
-            border-color: #ff0000;
-        }
-        
-        .btn-danger:hover {
-            background: white;
-            color: #ff0000;
-            box-shadow: 0 0 10px #ff0000;
-        }
-        
-        .btn-warning {
-            background: #ffaa00;
-            color: black;
-            border-color: #ffaa00;
-        }
-        
-        .btn-warning:hover {
-            background: black;
-            color: #ffaa00;
-            box-shadow: 0 0 10px #ffaa00;
-        }
-        
-        .hidden {
-            display: none;
-        }
-        
-        h1 {
-            text-shadow: 0 0 10px #00ff00;
-        }
-        
-        h2 {
-            color: #00ff00 !important;
-            text-shadow: 0 0 5px #00ff00;
-        }
-    </style>
-</head>
-<body>
-    <!-- Login Form -->
-    <div id="loginForm" class="login-form">
-        <h2 style="text-align: center; margin-bottom: 30px; color: #00ff00;">Login to Chatroom</h2>
-        <form onsubmit="login(event)">
-            <div class="form-group">
-                <label for="loginUsername">Username:</label>
-                <input type="text" id="loginUsername" required>
-            </div>
-            <div class="form-group">
-                <label for="loginPassword">Password:</label>
-                <input type="password" id="loginPassword" required>
-            </div>
-            <button type="submit" class="btn-primary">Login</button>
-        </form>
-        <div class="switch-form">
-            <a href="#" onclick="showRegister()">Don't have an account? Register here</a>
-        </div>
-    </div>
-    
-    <!-- Register Form -->
-    <div id="registerForm" class="register-form hidden">
-        <h2 style="text-align: center; margin-bottom: 30px; color: #00ff00;">Create Account</h2>
-        <form onsubmit="register(event)">
-            <div class="form-group">
-                <label for="regUsername">Username:</label>
-                <input type="text" id="regUsername" required>
-            </div>
-            <div class="form-group">
-                <label for="regEmail">Email (optional):</label>
-                <input type="email" id="regEmail">
-            </div>
-            <div class="form-group">
-                <label for="regPassword">Password:</label>
-                <input type="password" id="regPassword" required>
-            </div>
-            <button type="submit" class="btn-primary">Create Account</button>
-        </form>
-        <div class="switch-form">
-            <a href="#" onclick="showLogin()">Already have an account? Login here</a>
-        </div>
-    </div>
-    
-    <!-- Chat Interface -->
-    <div id="chatInterface" class="container hidden">
-        <div class="header">
-            <h1>💬 Chatroom</h1>
-            <div class="user-info">
-                <span id="currentUser"></span>
-                <button class="admin-btn" id="adminBtn" onclick="showAdmin()" style="display: none;">Admin</button>
-                <button class="logout-btn" onclick="logout()">Logout</button>
-            </div>
-        </div>
-        
-        <div class="messages" id="messages"></div>
-        
-        <div class="input-area">
-            <div class="message-type-selector">
-                <button class="type-btn active" onclick="setMessageType('text')">Text</button>
-                <button class="type-btn" onclick="setMessageType('image')">Image</button>
-                <button class="type-btn" onclick="setMessageType('text+image')">Text + Image</button>
-                <button class="type-btn" onclick="setMessageType('url')">URL</button>
-            </div>
+def script_statements(script):
+    """Split a SQL script into statements, keeping trigger bodies whole"""
+    statement = ''
+    for part in script.split(';'):
+        statement += part + ';'
+        if sqlite3.complete_statement(statement):
+            if statement.strip(' \n;'):
+                yield statement
+            statement = ''
+
+def apply_migrations(conn):
+    """Bring the schema up to date with MIGRATIONS.
+
+    Each migration runs in its own BEGIN IMMEDIATE transaction, which
+    re-reads user_version, so worker processes starting together apply
+    every migration once between them.
+    """
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(MIGRATIONS):
+            conn.rollback()
+            return
+        try:
+            for statement in script_statements(MIGRATIONS[version]):
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+def migrate_image_data(batch_size=IMAGE_MIGRATION_BATCH):
+    """Move legacy base64 images from messages.image_data into the blob store.
+
+    Works in small batches so it can run against a live database. Returns
+    the number of messages migrated.
+    """
+    migrated = 0
+    last_id = 0
+    with db_pool.connection() as conn:
+        while True:
+            rows = conn.execute(
+                'SELECT id, image_data FROM messages WHERE id > ? AND image_data IS NOT NULL ORDER BY id LIMIT ?',
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            updates = []
+            for row in rows:
+                try:
+                    data = base64.b64decode(row['image_data'])
+                except ValueError:
+                    data = None
+                image = None
+                if data:
+                    image = (save_image_file(data), sniff_image_type(data) or 'application/octet-stream', len(data))
+                updates.append((row['id'], image))
             
-            <div class="input-group">
-                <input type="text" class="input-field" id="messageInput" placeholder="Type your message...">
-                <input type="url" class="input-field hidden" id="urlInput" placeholder="Enter URL...">
-                <input type="file" class="file-input" id="imageInput" accept="image/*">
-                <button class="file-btn hidden" id="fileBtn" onclick="document.getElementById('imageInput').click()">📁</button>
-                <button class="send-btn" onclick="sendMessage()">Send</button>
-            </div>
-        </div>
-    </div>
-    
-    <!-- Admin Panel -->
-    <div id="adminPanel" class="admin-panel hidden">
-        <h2 style="text-align: center; margin-bottom: 30px; color: #00ff00;">Admin Dashboard</h2>
-        
-        <div class="admin-section">
-            <h3>Settings</h3>
-            <div class="form-group">
-                <label for="maxImageSize">Max Image Size (KB):</label>
-                <input type="number" id="maxImageSize" value="1024">
-                <button onclick="updateSettings()" style="margin-top: 10px;" class="btn-primary">Update Settings</button>
-            </div>
-        </div>
-        
-        <div class="admin-section">
-            <h3>Users</h3>
-            <div id="usersList" class="user-list"></div>
-        </div>
-        
-        <div class="admin-section">
-            <h3>Actions</h3>
-            <button onclick="deleteAllMessages()" class="btn-danger" style="width: 100%; margin-bottom: 10px;">Delete All Messages</button>
-        </div>
-        
-        <button onclick="hideAdmin()" class="btn-primary">Back to Chat</button>
-    </div>
-    
-    <script>
-        let currentMessageType = 'text';
-        let currentUser = null;
-        let isAdmin = false;
-        
-        // Check if user is logged in on page load
-        window.onload = function() {
-            checkLoginStatus();
-            if (currentUser) {
-                loadMessages();
-                setInterval(loadMessages, 2000); // Poll for new messages every 2 seconds
-            }
-        };
-        
-        function checkLoginStatus() {
-            fetch('/api/check_login')
-                .then(response => response.json())
-                .then(data => {
-                    if (data.logged_in) {
-                        currentUser = data.username;
-                        isAdmin = data.is_admin;
-                        showChat();
-                    }
-                });
-        }
-        
-        function login(event) {
-            event.preventDefault();
-            const username = document.getElementById('loginUsername').value;
-            const password = document.getElementById('loginPassword').value;
+            def move_batch(conn):
+                for message_id, image in updates:
+                    if image:
+                        record_image(conn, *image)
+                    conn.execute('UPDATE messages SET image_key = ?, image_data = NULL WHERE id = ?',
+                                 (image[0] if image else None, message_id))
             
-            fetch('/api/login', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({username, password})
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    currentUser = username;
-                    isAdmin = data.is_admin;
-                    showChat();
-                    loadMessages();
-                    setInterval(loadMessages, 2000);
-                } else {
-                    alert(data.message);
-                }
-            });
-        }
-        
-        function register(event) {
-            event.preventDefault();
-            const username = document.getElementById('regUsername').value;
-            const email = document.getElementById('regEmail').value;
-            const password = document.getElementById('regPassword').value;
+            db_writer.run(move_batch)
+            migrated += len(rows)
+    # No code writes image_data any more, so no later run would find rows
+    db_writer.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('images_migrated', '1')")
+    return migrated
+
+def vacuum_database():
+    """Rebuild the database file, switching it to incremental auto_vacuum"""
+    conn = open_connection(DATABASE, isolation_level=None)
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    conn.close()
+
+@app.cli.command('migrate-images')
+def migrate_images_command():
+    """Move base64 images out of the messages table and compact the database."""
+    init_db()
+    migrated = migrate_image_data()
+    vacuum_database()
+    print(f'Migrated {migrated} images')
+
+@app.cli.command('vacuum')
+def vacuum_command():
+    """Compact the database and enable incremental vacuum on older files."""
+    init_db()
+    vacuum_database()
+    print('Database compacted')
+
+@app.cli.command('enforce-retention')
+def enforce_retention_command():
+    """Run one retention pass now."""
+    init_db()
+    print(f'Removed {retention.enforce()} messages')
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Re-index all message content for search and merge the index."""
+    init_db()
+    
+    def rebuild(conn):
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+        return conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    
+    print(f'Indexed {db_writer.run(rebuild)} messages')
+
+@app.cli.command('generate-variants')
+def generate_variants_command():
+    """Render missing image variants for images already in the store."""
+    init_db()
+    if not imaging.variants_supported():
+        raise SystemExit('Pillow is not installed')
+    with db_pool.connection() as conn:
+        keys = [row['key'] for row in conn.execute(
+            'SELECT key FROM images WHERE key NOT IN (SELECT image_key FROM image_variants)'
+        )]
+    with ProcessPoolExecutor(IMAGE_WORKERS) as pool:
+        futures = {key: pool.submit(*image_variants.job(key)) for key in keys}
+        for key, future in futures.items():
+            try:
+                image_variants.record(key, future.result())
+            except Exception as e:
+                print(f'{key}: {e}')
+    print(f'Processed {len(keys)} images')
+
+def metric_labels(names, values):
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+class Counter:
+    """A Prometheus counter with labels"""
+    
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, values, amount=1):
+        with self._lock:
+            self._series[values] = self._series.get(values, 0) + amount
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            series = list(self._series.items())
+        for values, total in series:
+            lines.append(f'{self.name}{{{metric_labels(self.labels, values)}}} {total}')
+        return lines
+
+class Histogram:
+    """A Prometheus histogram with labels and fixed buckets"""
+    
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+    
+    def observe(self, values, amount):
+        index = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += amount
+            series[2] += 1
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(values, list(counts), total, count) for values, (counts, total, count) in self._series.items()]
+        for values, counts, total, count in series:
+            labels = metric_labels(self.labels, values)
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+REQUEST_LATENCY = Histogram('chat_request_duration_seconds', 'Time to produce a response',
+                            ('endpoint', 'method'), LATENCY_BUCKETS)
+REQUEST_COUNT = Counter('chat_requests_total', 'Responses by status', ('endpoint', 'method', 'status'))
+RESPONSE_SIZE = Histogram('chat_response_size_bytes', 'Response body sizes, where known in advance',
+                          ('endpoint',), SIZE_BUCKETS)
+SQL_LATENCY = Histogram('chat_sql_duration_seconds', 'Time to run a statement up to its first row',
+                        ('statement',), SQL_LATENCY_BUCKETS)
+SQL_ROWS = Counter('chat_sql_rows_total', 'Rows fetched', ('statement',))
+METRICS = [REQUEST_LATENCY, REQUEST_COUNT, RESPONSE_SIZE, SQL_LATENCY, SQL_ROWS]
+
+SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """Statement text with literals replaced, to label its metrics by"""
+    return SQL_LITERAL_RE.sub('?', ' '.join(sql.split()))
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records statement latency and rows fetched"""
+    
+    statement = None
+    
+    def execute(self, sql, parameters=()):
+        self.statement = (normalize_sql(sql),)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            SQL_LATENCY.observe(self.statement, time.perf_counter() - started)
+    
+    def executemany(self, sql, seq_of_parameters):
+        self.statement = (normalize_sql(sql),)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            SQL_LATENCY.observe(self.statement, time.perf_counter() - started)
+    
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            SQL_ROWS.inc(self.statement)
+        return row
+    
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        SQL_ROWS.inc(self.statement, len(rows))
+        return rows
+    
+    def fetchall(self):
+        rows = super().fetchall()
+        SQL_ROWS.inc(self.statement, len(rows))
+        return rows
+    
+    def __next__(self):
+        row = super().__next__()
+        SQL_ROWS.inc(self.statement)
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose statements all run through InstrumentedCursor"""
+    
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def open_connection(database, pragmas=SQLITE_PRAGMAS, **kwargs):
+    """Open a SQLite connection with the storage profile's PRAGMAs applied"""
+    conn = sqlite3.connect(database, factory=InstrumentedConnection, **kwargs)
+    conn.row_factory = sqlite3.Row
+    for name, value in pragmas:
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+class PoolTimeout(Exception):
+    """No database connection became free in time"""
+
+class ConnectionPool:
+    """A bounded pool of warm SQLite connections.
+
+    A thread gets back the connection it used last when that one is idle, so
+    under a thread-per-request server each worker thread keeps reusing the
+    same connection and its page cache. PRAGMAs are applied once, when a
+    connection is opened.
+    """
+    
+    def __init__(self, database, max_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, pragmas=SQLITE_PRAGMAS):
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self._idle = []
+        self._size = 0
+        self._affinity = threading.local()
+        self._cond = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+    
+    def _connect(self):
+        return open_connection(self.database, self.pragmas, check_same_thread=False)
+    
+    def acquire(self):
+        with self._cond:
+            preferred = getattr(self._affinity, 'conn', None)
+            if self._idle:
+                self.hits += 1
+                if preferred is not None and preferred in self._idle:
+                    self._idle.remove(preferred)
+                    return preferred
+                return self._idle.pop()
             
-            fetch('/api/register', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({username, email, password})
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    alert('Account created successfully! Please login.');
-                    showLogin();
-                } else {
-                    alert(data.message);
-                }
-            });
-        }
-        
-        function logout() {
-            fetch('/api/logout', {method: 'POST'})
-                .then(() => {
-                    currentUser = null;
-                    isAdmin = false;
-                    showLogin();
-                });
-        }
-        
-        function showLogin() {
-            document.getElementById('loginForm').classList.remove('hidden');
-            document.getElementById('registerForm').classList.add('hidden');
-            document.getElementById('chatInterface').classList.add('hidden');
-            document.getElementById('adminPanel').classList.add('hidden');
-        }
-        
-        function showRegister() {
-            document.getElementById('loginForm').classList.add('hidden');
-            document.getElementById('registerForm').classList.remove('hidden');
-            document.getElementById('chatInterface').classList.add('hidden');
-            document.getElementById('adminPanel').classList.add('hidden');
-        }
-        
-        function showChat() {
-            document.getElementById('loginForm').classList.add('hidden');
-            document.getElementById('registerForm').classList.add('hidden');
-            document.getElementById('chatInterface').classList.remove('hidden');
-            document.getElementById('adminPanel').classList.add('hidden');
-            document.getElementById('currentUser').textContent = currentUser;
+            if self._size >= self.max_size:
+                self.waits += 1
+                started = time.perf_counter()
+                available = self._cond.wait_for(lambda: self._idle or self._size < self.max_size, self.timeout)
+                waited = time.perf_counter() - started
+                self.wait_time_total += waited
+                self.wait_time_max = max(self.wait_time_max, waited)
+                if not available:
+                    self.timeouts += 1
+                    raise PoolTimeout(f'No database connection available after {self.timeout}s')
+                if self._idle:
+                    self.hits += 1
+                    return self._idle.pop()
             
-            if (isAdmin) {
-                document.getElementById('adminBtn').style.display = 'block';
+            self.misses += 1
+            self._size += 1
+        
+        try:
+            return self._connect()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+    
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # A broken connection is dropped rather than handed out again
+            conn.close()
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+        self._affinity.conn = conn
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+    
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with block"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+    
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'wait_time_total': self.wait_time_total,
+                'wait_time_max': self.wait_time_max
             }
+
+db_pool = ConnectionPool(DATABASE)
+
+class WriteJob:
+    def __init__(self, func, after_commit):
+        self.func = func
+        self.after_commit = after_commit
+        self.future = Future()
+
+class DatabaseWriter:
+    """Runs every database write on one dedicated thread.
+
+    SQLite allows a single writer at a time, so instead of request threads
+    contending for the lock, writes are queued here. Whatever has queued up
+    while the previous transaction committed is run as one batch and
+    committed together (group commit); each job runs in its own SAVEPOINT so
+    a failing job does not take the rest of the batch down with it.
+
+    A job is a function taking the writer's connection; it must not commit.
+    Its after_commit callback runs on the writer thread once the batch is
+    durable, in commit order, with the job's result.
+    """
+    
+    def __init__(self, database, max_batch=WRITE_BATCH_SIZE):
+        self.database = database
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.jobs = 0
+        self.failed = 0
+        self.batches = 0
+        self.commit_time_total = 0.0
+        self.commit_time_max = 0.0
+        self.commit_time_avg = 0.0  # Moving average over recent batches
+    
+    def submit(self, func, after_commit=None):
+        """Queue a write and return a Future for its result"""
+        self._ensure_started()
+        job = WriteJob(func, after_commit)
+        self._queue.put(job)
+        return job.future
+    
+    def run(self, func, after_commit=None, timeout=WRITE_TIMEOUT):
+        """Queue a write and wait for it to commit"""
+        return self.submit(func, after_commit).result(timeout)
+    
+    def execute(self, sql, params=()):
+        """Run a single statement and return the number of rows changed"""
+        return self.run(lambda conn: conn.execute(sql, params).rowcount)
+    
+    def queue_depth(self):
+        return self._queue.qsize()
+    
+    def _ensure_started(self):
+        # Started lazily so each worker process of a forking server gets its own
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+    
+    def _run(self):
+        conn = open_connection(self.database, isolation_level=None, check_same_thread=False)
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write_batch(conn, batch)
+    
+    def _write_batch(self, conn, batch):
+        started = time.perf_counter()
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for job in batch:
+                conn.execute('SAVEPOINT job')
+                try:
+                    results.append((job, job.func(conn), None))
+                    conn.execute('RELEASE job')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO job')
+                    conn.execute('RELEASE job')
+                    results.append((job, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for job in batch:
+                job.future.set_exception(e)
+            self.failed += len(batch)
+            return
+        
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.jobs += len(batch)
+        self.commit_time_total += elapsed
+        self.commit_time_max = max(self.commit_time_max, elapsed)
+        self.commit_time_avg += (elapsed - self.commit_time_avg) * 0.2
+        
+        for job, result, error in results:
+            if error is not None:
+                self.failed += 1
+                job.future.set_exception(error)
+                continue
+            if job.after_commit is not None:
+                try:
+                    job.after_commit(result)
+                except Exception:
+                    app.logger.exception('after_commit callback failed')
+            job.future.set_result(result)
+    
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'jobs': self.jobs,
+            'failed': self.failed,
+            'batches': self.batches,
+            'avg_batch_size': self.jobs / self.batches if self.batches else 0,
+            'commit_time_total': self.commit_time_total,
+            'commit_time_max': self.commit_time_max,
+            'commit_time_avg': self.commit_time_avg
         }
-        
-        function showAdmin() {
-            if (!isAdmin) return;
-            document.getElementById('adminPanel').classList.remove('hidden');
-            document.getElementById('chatInterface').classList.add('hidden');
-            loadAdminData();
-        }
-        
-        function hideAdmin() {
-            document.getElementById('adminPanel').classList.add('hidden');
-            document.getElementById('chatInterface').classList.remove('hidden');
+
+db_writer = DatabaseWriter(DATABASE)
+
+def get_db():
+    """Get the database connection for the current request"""
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+def password_params(scheme=PASSWORD_SCHEME):
+    return SCRYPT_COST if scheme == 'scrypt' else (PBKDF2_ITERATIONS,)
+
+def hash_password(password):
+    """Hash password with the configured KDF, in the calling thread"""
+    return passwords.hash_password(password, PASSWORD_SCHEME, password_params())
+
+class PasswordHasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    """Runs password hashing on a bounded pool of threads.
+
+    Key derivation is deliberately slow, so a burst of logins would take
+    every request thread and CPU with it. Here at most `workers` hashes run
+    at once and no more than `max_queued` wait; past that, submitting
+    raises PasswordHasherBusy straight away instead of queueing. A hash
+    not done within PASSWORD_TIMEOUT raises it too.
+    """
+    
+    def __init__(self, workers=PASSWORD_WORKERS, max_queued=PASSWORD_QUEUE_DEPTH):
+        self.workers = workers
+        self.max_queued = max_queued
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='password')
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.timeouts = 0
+    
+    def _run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.workers + self.max_queued:
+                self.rejected += 1
+                raise PasswordHasherBusy()
+            self.pending += 1
+        future = self._pool.submit(fn, *args)
+        future.add_done_callback(self._done)
+        try:
+            return future.result(PASSWORD_TIMEOUT)
+        except FutureTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise PasswordHasherBusy()
+    
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+    
+    def hash(self, password):
+        return self._run(hash_password, password)
+    
+    def verify(self, password, encoded):
+        """(matches, replacement hash or None) for a stored hash.
+
+        With no stored hash a fresh one is still derived, so unknown
+        usernames take as long to refuse as wrong passwords.
+        """
+        return self._run(self._verify, password, encoded)
+    
+    def _verify(self, password, encoded):
+        if encoded is None:
+            hash_password(password)
+            return False, None
+        if not passwords.verify_password(password, encoded):
+            return False, None
+        if passwords.needs_rehash(encoded, PASSWORD_SCHEME, password_params()):
+            with self._lock:
+                self.rehashed += 1
+            return True, hash_password(password)
+        return True, None
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'scheme': PASSWORD_SCHEME,
+                'workers': self.workers,
+                'pending': self.pending,
+                'rejected': self.rejected,
+                'rehashed': self.rehashed,
+                'timeouts': self.timeouts,
+            }
+
+password_hasher = PasswordHasher()
+
+def password_busy_response():
+    response = jsonify({'success': False, 'message': 'Server busy, please try again shortly'})
+    response.headers['Retry-After'] = str(SHED_RETRY_AFTER)
+    return response, 503
+
+class DataVersionWatcher:
+    """Notices commits made through other database connections.
+
+    PRAGMA data_version on a connection changes whenever some other
+    connection, in this process or another, commits. Checking it is a cheap
+    in-memory read, done at most once per interval.
+    """
+    
+    def __init__(self, database, interval=CHANGE_POLL_INTERVAL):
+        self.database = database
+        self.interval = interval
+        self.conn = None
+        self._data_version = None
+        self._next_check = 0.0
+    
+    def changed(self):
+        """True if anything was committed since the last call (rate limited)"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.interval
+        if self.conn is None:
+            self.conn = open_connection(self.database, check_same_thread=False)
+        data_version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        changed = data_version != self._data_version
+        self._data_version = data_version
+        return changed
+
+class SettingsRegistry:
+    """In-memory, typed copy of the settings table.
+
+    Reads are dictionary lookups. Writes go to the database and bump a
+    settings_version row; other worker processes notice the commit through
+    DataVersionWatcher and reload when that version has moved.
+    """
+    
+    def __init__(self, database, schema=SETTINGS_SCHEMA):
+        self.schema = schema
+        self._values = None
+        self._version = None
+        self._watcher = DataVersionWatcher(database)
+        self._lock = threading.Lock()
+    
+    def _refresh(self):
+        with self._lock:
+            if not self._watcher.changed() and self._values is not None:
+                return
+            conn = self._watcher.conn
+            version = conn.execute(SETTING_SQL, ('settings_version',)).fetchone()
+            version = version['value'] if version else None
+            if self._values is not None and version == self._version:
+                return
+            values = {}
+            for row in conn.execute('SELECT key, value FROM settings'):
+                if row['key'] in self.schema:
+                    values[row['key']] = self.schema[row['key']][0](row['value'])
+            self._values = values
+            self._version = version
+    
+    def get(self, key):
+        self._refresh()
+        value = self._values.get(key)
+        if value is None:
+            value = self.schema[key][1]
+        return value
+    
+    def set(self, key, value):
+        value = self.schema[key][0](value)
+        
+        def write(conn):
+            conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, str(value)))
+            conn.execute('''
+                INSERT INTO settings (key, value) VALUES ('settings_version', '1')
+                ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+            ''')
+        
+        db_writer.run(write)
+        self._refresh()
+        with self._lock:
+            self._values[key] = value
+
+settings = SettingsRegistry(DATABASE)
+
+# Flags kept per user by UserStates
+USER_EXISTS = 1
+USER_BANNED = 2
+USER_ADMIN = 4
+
+def bump_users_version(conn):
+    """Tell every process to reload user states; call in the changing transaction"""
+    conn.execute('''
+        INSERT INTO settings (key, value) VALUES ('users_version', '1')
+        ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    ''')
+
+class UserStates:
+    """In-memory ban and admin flags of every user, so requests can be
+    authorized without a query.
+
+    Flags are one byte per user id in a bytearray. A background thread
+    keeps it current: when another connection has committed it reads any
+    users added since, and when users_version has moved (changes to flags
+    call bump_users_version() in the same transaction) it reloads them all
+    into a new array and swaps it in. Requests only ever read memory. The
+    array covers every id issued so far (users is AUTOINCREMENT), so a
+    deleted user reads as 0 even when it had the highest id. Ids past the
+    end are users registered since the last check, who have no flags worth
+    knowing yet.
+    """
+    
+    def __init__(self, database, interval=CHANGE_POLL_INTERVAL):
+        self.interval = interval
+        self._flags = None
+        self._version = None
+        self._watcher = DataVersionWatcher(database, interval=0)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.reloads = 0
+    
+    def load(self):
+        """Read the flags and start keeping them current"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='user-states', daemon=True)
+        self._refresh()
+        self._thread.start()
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._refresh()
+            except Exception:
+                app.logger.exception('Refreshing user states failed')
+    
+    def _refresh(self):
+        with self._lock:
+            if not self._watcher.changed() and self._flags is not None:
+                return
+            conn = self._watcher.conn
+            version = conn.execute(SETTING_SQL, ('users_version',)).fetchone()
+            version = version['value'] if version else None
+            # Read before the users so any id it covers but they lack was deleted
+            issued = conn.execute(USER_SEQUENCE_SQL).fetchone()
+            issued = issued['seq'] if issued else 0
+            if self._flags is None or version != self._version:
+                flags, rows = bytearray(), conn.execute(USER_STATES_SQL)
+                self.reloads += 1
+            else:
+                flags = self._flags
+                rows = conn.execute(USER_STATES_AFTER_SQL, (len(flags) - 1,)).fetchall()
+                if not rows and issued < len(flags):
+                    return
+                flags = bytearray(flags)
+            for row in rows:
+                if row['id'] >= len(flags):
+                    flags.extend(bytes(row['id'] + 1 - len(flags)))
+                flags[row['id']] = self.pack(row)
+            if issued >= len(flags):
+                flags.extend(bytes(issued + 1 - len(flags)))
+            self._flags = flags
+            self._version = version
+    
+    def pack(self, row):
+        return USER_EXISTS | (USER_BANNED if row['is_banned'] else 0) | (USER_ADMIN if row['is_admin'] else 0)
+    
+    def get(self, user_id):
+        """The user's flags; 0 if there is no such user, None if not known yet"""
+        flags = self._flags
+        if flags is None or user_id >= len(flags):
+            return None
+        return flags[user_id]
+    
+    def allowed(self, user_id):
+        flags = self.get(user_id)
+        return flags is None or flags & (USER_EXISTS | USER_BANNED) == USER_EXISTS
+    
+    def update(self, user_id, banned):
+        """Record a ban change this process has committed"""
+        with self._lock:
+            flags = self._flags
+            if flags is None:
+                return
+            if user_id >= len(flags):
+                # Registered since the last check, so neither banned nor an admin before
+                flags = self._flags = flags + bytes(user_id + 1 - len(flags))
+                flags[user_id] = USER_EXISTS
+            if flags[user_id]:
+                flags[user_id] = flags[user_id] & ~USER_BANNED | (USER_BANNED if banned else 0)
+    
+    def stats(self):
+        flags = self._flags or bytearray()
+        return {
+            'users': len(flags) - flags.count(0),
+            'bytes': len(flags),
+            'reloads': self.reloads,
         }
-        
-        function setMessageType(type) {
-            currentMessageType = type;
-            
-            // Update button states
-            document.querySelectorAll('.type-btn').forEach(btn => btn.classList.remove('active'));
-            event.target.classList.add('active');
-            
-            // Show/hide relevant inputs
-            const messageInput = document.getElementById('messageInput');
-            const urlInput = document.getElementById('urlInput');
-            const fileBtn = document.getElementById('fileBtn');
-            
-            messageInput.classList.add('hidden');
-            urlInput.classList.add('hidden');
-            fileBtn.classList.add('hidden');
+
+user_states = UserStates(DATABASE)
+
+def ensure_secret_key():
+    """Load the session key from the settings table unless one is set"""
+    if not app.secret_key:
+        with db_pool.connection() as conn:
+            row = conn.execute(SETTING_SQL, ('secret_key',)).fetchone()
+        if row is None:
+            db_writer.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)',
+                              ('secret_key', secrets.token_hex(32)))
+            with db_pool.connection() as conn:
+                row = conn.execute(SETTING_SQL, ('secret_key',)).fetchone()
+        app.secret_key = row['value']
+    return app.secret_key
+
+class SharedKeySessionInterface(SecureCookieSessionInterface):
+    """Cookie sessions signed with the shared key, however the app is started"""
+    
+    def get_signing_serializer(self, app):
+        ensure_secret_key()
+        return super().get_signing_serializer(app)
+
+app.session_interface = SharedKeySessionInterface()
+
+def get_setting(key):
+    """Get a setting's typed value"""
+    return settings.get(key)
+
+def update_setting(key, value):
+    """Update setting in database"""
+    settings.set(key, value)
+
+class Subscriber:
+    """A streaming client's bounded event queue"""
+    
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.closed = False
+    
+    def offer(self, frame):
+        """Queue a frame without blocking; False if the client has fallen behind"""
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            return False
+
+class MessageHub:
+    """In-process fan-out of chat events to streaming clients.
+
+    Each event is encoded once as an SSE frame and offered to every
+    subscriber without blocking. A subscriber whose queue is full is
+    disconnected; its client reconnects and catches up through the
+    /api/messages cursor.
+    """
+    
+    def __init__(self, queue_size=STREAM_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.dropped = 0
+    
+    def subscribe(self, subscriber=None):
+        """Register a subscriber, by default a thread-safe Subscriber"""
+        if subscriber is None:
+            subscriber = Subscriber(self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+    
+    def publish(self, event, data, event_id=None):
+        frame = f'event: {event}\n'
+        if event_id is not None:
+            frame += f'id: {event_id}\n'
+        frame += f'data: {json.dumps(data)}\n\n'
+        frame = frame.encode('utf-8')
+        
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if not subscriber.offer(frame):
+                subscriber.closed = True
+                self.unsubscribe(subscriber)
+                self.dropped += 1
+    
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+message_hub = MessageHub()
+
+def encode_json(data):
+    return json.dumps(data, separators=(',', ':'))
+
+class RecentMessages:
+    """Process-wide ring buffer of the newest messages and deletions.
+
+    Every message is kept with its JSON encoding, so a /api/messages reply
+    is assembled from ready-made fragments. The buffer holds every message
+    with an id above ``floor``; as old messages fall off the end, floor
+    rises, and a client whose cursor is below it gets a reset page.
+
+    It is filled from the database on first use and then kept current by
+    the writer's after_commit callbacks, which run in commit order.
+    """
+    
+    def __init__(self, capacity=RECENT_CACHE_SIZE, deletion_capacity=MAX_DELETIONS_PER_SYNC):
+        self.capacity = capacity
+        self._messages = deque(maxlen=capacity)  # (id, username, encoded)
+        self._deletions = deque(maxlen=deletion_capacity)  # (seq, encoded)
+        self._floor = None  # None while cold
+        self._deletion_floor = 0
+        self.deletion_seq = 0
+        self.version = 0  # Bumped whenever the contents change
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    def _warm(self, conn):
+        rows = conn.execute(TIMELINE_LATEST_SQL, (self.capacity,)).fetchall()[::-1]
+        self._messages.clear()
+        self.bytes = 0
+        for row in rows:
+            self._push(serialize_message(row))
+        self._floor = rows[0]['id'] - 1 if len(rows) == self.capacity else 0
+        self.deletion_seq = conn.execute(LATEST_DELETION_SQL).fetchone()[0]
+        self._deletions.clear()
+        self._deletion_floor = self.deletion_seq
+        self.version += 1
+    
+    def _push(self, message):
+        encoded = encode_json(message)
+        if len(self._messages) == self._messages.maxlen:
+            evicted_id, _, evicted = self._messages[0]
+            self.bytes -= len(evicted)
+            self._floor = evicted_id
+        self._messages.append((message['id'], message['username'], encoded))
+        self.bytes += len(encoded)
+        self.version += 1
+    
+    def append(self, message):
+        """Add a newly committed message"""
+        with self._lock:
+            if self._floor is None:
+                return
+            if self._messages and message['id'] <= self._messages[-1][0]:
+                return  # already loaded while warming
+            self._push(message)
+    
+    def apply_deletion(self, deletion):
+        """Drop the messages a committed deletion removed"""
+        with self._lock:
+            if self._floor is None or deletion['seq'] <= self.deletion_seq:
+                return
+            if deletion['scope'] == 'all':
+                kept = []
+            elif deletion['scope'] == 'user':
+                kept = [m for m in self._messages if m[1] != deletion['target']]
+            elif deletion['scope'] == 'before':
+                kept = [m for m in self._messages if m[0] > int(deletion['target'])]
+            elif deletion['scope'] == 'user_before':
+                through, _, username = deletion['target'].partition(':')
+                kept = [m for m in self._messages if m[0] > int(through) or m[1] != username]
+            else:
+                self._clear()
+                return
+            self._messages.clear()
+            self._messages.extend(kept)
+            self.bytes = sum(len(m[2]) for m in kept)
+            if len(self._deletions) == self._deletions.maxlen:
+                self._deletion_floor = self._deletions[0][0]
+            self._deletions.append((deletion['seq'], encode_json(deletion)))
+            self.deletion_seq = deletion['seq']
+            self.version += 1
+    
+    @property
+    def warm(self):
+        """True when a sync will be answered without touching the database"""
+        return self._floor is not None
+    
+    def invalidate(self):
+        """Forget everything; the next read reloads from the database"""
+        with self._lock:
+            self._clear()
+    
+    def _clear(self):
+        self._floor = None
+        self._messages.clear()
+        self._deletions.clear()
+        self.bytes = 0
+        self.version += 1
+    
+    def sync(self, after_id, deleted_after, get_conn):
+        """Return the encoded /api/messages reply for a client's cursors"""
+        with self._lock:
+            if self._floor is None:
+                self.misses += 1
+                self._warm(get_conn())
+            else:
+                self.hits += 1
             
-            if (type === 'text') {
-                messageInput.classList.remove('hidden');
-                messageInput.placeholder = 'Type your message...';
-            } else if (type === 'image') {
-                fileBtn.classList.remove('hidden');
-            } else if (type === 'text+image') {
-                messageInput.classList.remove('hidden');
-                fileBtn.classList.remove('hidden');
-                messageInput.placeholder = 'Type your message...';
-            } else if (type === 'url') {
-                messageInput.classList.remove('hidden');
-                urlInput.classList.remove('hidden');
-                messageInput.placeholder = 'Description (optional)...';
-            }
-        }
-        
-        function sendMessage() {
-            const messageInput = document.getElementById('messageInput');
-            const urlInput = document.getElementById('urlInput');
-            const imageInput = document.getElementById('imageInput');
+            reset = after_id is None or after_id < self._floor or deleted_after < self._deletion_floor
+            messages = []
+            if not reset:
+                for message in reversed(self._messages):
+                    if message[0] <= after_id:
+                        break
+                    messages.append(message)
+                messages.reverse()
+                deletions = [d for d in self._deletions if d[0] > deleted_after]
+                reset = len(messages) > MESSAGE_PAGE_SIZE
+            if reset:
+                messages = list(self._messages)[-MESSAGE_PAGE_SIZE:]
+                deletions = []
             
-            const formData = new FormData();
-            formData.append('message_type', currentMessageType);
+            if messages:
+                last_id = messages[-1][0]
+            else:
+                last_id = 0 if reset else after_id
             
-            if (currentMessageType === 'text') {
-                if (!messageInput.value.trim()) return;
-                formData.append('content', messageInput.value.trim());
-            } else if (currentMessageType === 'image') {
-                if (!imageInput.files[0]) return;
-                formData.append('image', imageInput.files[0]);
-            } else if (currentMessageType === 'text+image') {
-                if (!messageInput.value.trim() && !imageInput.files[0]) return;
-                formData.append('content', messageInput.value.trim());
-                if (imageInput.files[0]) {
-                    formData.append('image', imageInput.files[0]);
-                }
-            } else if (currentMessageType === 'url') {
-                if (!urlInput.value.trim()) return;
-                formData.append('url', urlInput.value.trim());
-                formData.append('content', messageInput.value.trim());
+            return (
+                '{"messages":[' + ','.join(m[2] for m in messages) + '],'
+                '"last_id":' + str(last_id) + ','
+                '"deletions":[' + ','.join(d[1] for d in deletions) + '],'
+                '"deletion_seq":' + str(self.deletion_seq) + ','
+                '"reset":' + ('true' if reset else 'false') + '}'
+            )
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'warm': self.warm,
+                'size': len(self._messages),
+                'capacity': self.capacity,
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0
             }
+
+recent_messages = RecentMessages()
+
+class RetentionManager:
+    """Removes messages that fall outside the retention settings.
+
+    A background thread wakes every interval and finds the newest message
+    the policy no longer keeps: older than retention_days, beyond the newest
+    retention_max_messages, or oldest-first while the database holds more
+    than retention_max_bytes. Messages are removed a chunk at a time, each
+    chunk a short job on the writer so chat writes carry on between them,
+    and each announced to clients as a 'before' deletion. With
+    retention_archive set, a chunk is first copied into the month's archive
+    database. Freed pages are returned with incremental vacuum.
+    """
+    
+    def __init__(self, interval=RETENTION_INTERVAL, chunk_size=RETENTION_CHUNK, archive_folder=ARCHIVE_FOLDER):
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.archive_folder = archive_folder
+        self._thread = None
+        self._lock = threading.Lock()
+        self.passes = 0
+        self.removed = 0
+        self.archived = 0
+        self.last_run = None
+    
+    def ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+                self._thread.start()
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.enforce()
+            except Exception:
+                app.logger.exception('Retention pass failed')
+    
+    def enforce(self):
+        """Apply the policy once and return the number of messages removed"""
+        days = settings.get('retention_days')
+        max_messages = settings.get('retention_max_messages')
+        max_bytes = settings.get('retention_max_bytes')
+        removed = 0
+        with db_pool.connection() as conn:
+            cutoff = 0
+            if days > 0:
+                since = datetime.now(timezone.utc) - timedelta(days=days)
+                row = conn.execute(RETENTION_AGE_SQL, (since.strftime('%Y-%m-%d %H:%M:%S'),)).fetchone()
+                cutoff = max(cutoff, row['id'] if row else 0)
+            if max_messages > 0:
+                row = conn.execute(RETENTION_COUNT_SQL, (max_messages,)).fetchone()
+                cutoff = max(cutoff, row['id'] if row else 0)
             
-            fetch('/api/send_message', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    messageInput.value = '';
-                    urlInput.value = '';
-                    imageInput.value = '';
-                    loadMessages();
-                } else {
-                    alert(data.message);
-                }
-            });
-        }
-        
-        function loadMessages() {
-            fetch('/api/messages')
-                .then(response => response.json())
-                .then(data => {
-                    const messagesDiv = document.getElementById('messages');
-                    messagesDiv.innerHTML = '';
-                    
-                    data.messages.forEach(message => {
-                        const messageDiv = document.createElement('div');
-                        messageDiv.className = 'message';
-                        
-                        let messageContent = `
-                            <div class="message-header">
-                                <span class="username">${message.username}</span>
-                                <span>${new Date(message.timestamp).toLocaleString()}</span>
-                            </div>
-                            <div class="message-content">
-                        `;
-                        
-                        if (message.content) {
-                            messageContent += `<div>${message.content}</div>`;
-                        }
-                        
-                        if (message.image_data) {
-                            messageContent += `<img src="data:image/jpeg;base64,${message.image_data}" class="message-image" alt="Image">`;
-                        }
-                        
-                        if (message.url) {
-                            messageContent += `<a href="${message.url}" target="_blank" class="message-url">${message.url}</a>`;
-                        }
-                        
-                        messageContent += `</div>`;
-                        messageDiv.innerHTML = messageContent;
-                        messagesDiv.appendChild(messageDiv);
-                    });
-                    
-                    messagesDiv.scrollTop = messagesDiv.scrollHeight;
-                });
-        }
-        
-        function loadAdminData() {
-            // Load current settings
-            fetch('/api/admin/settings')
-                .then(response => response.json())
-                .then(data => {
-                    document.getElementById('maxImageSize').value = Math.floor(data.max_image_size / 1024);
-                });
-            
-            // Load users
-            fetch('/api/admin/users')
-                .then(response => response.json())
-                .then(data => {
-                    const usersList = document.getElementById('usersList');
-                    usersList.innerHTML = '';
-                    
-                    data.users.forEach(user => {
-                        const userDiv = document.createElement('div');
-                        userDiv.className = 'user-item';
-                        userDiv.innerHTML = `
-                            <span>${user.username} (${user.email || 'No email'}) ${user.is_banned ? '[BANNED]' : ''}</span>
-                            <div class="user-actions">
-                                <button onclick="toggleBan(${user.id}, ${user.is_banned})" class="btn-warning">
-                                    ${user.is_banned ? 'Unban' : 'Ban'}
-                                </button>
-                                <button onclick="deleteUser(${user.id})" class="btn-danger">Delete</button>
-                            </div>
-                        `;
-                        usersList.appendChild(userDiv);
-                    });
-                });
-        }
-        
-        function updateSettings() {
-            const maxImageSize = document.getElementById('maxImageSize').value * 1024;
-            
-            fetch('/api/admin/update_settings', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({max_image_size: maxImageSize})
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    alert('Settings updated successfully!');
-                } else {
-                    alert('Error updating settings');
-                }
-            });
-        }
-        
-        function toggleBan(userId, isBanned) {
-            fetch('/api/admin/toggle_ban', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({user_id: userId, ban: !isBanned})
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    loadAdminData();
-                } else {
-                    alert('Error updating user status');
-                }
-            });
+            while True:
+                limit = cutoff
+                if max_bytes > 0 and self.used_bytes(conn) > max_bytes:
+                    limit = 2 ** 63 - 1
+                rows = conn.execute(RETENTION_CHUNK_SQL, (limit, self.chunk_size)).fetchall()
+                if not rows:
+                    break
+                if settings.get('retention_archive'):
+                    self.archive(rows)
+                removed += self.remove_through(rows[-1]['id'])
+        
+        self.passes += 1
+        self.removed += removed
+        self.last_run = datetime.now(timezone.utc).isoformat()
+        return removed
+    
+    def used_bytes(self, conn):
+        """Bytes of the database file in use, not counting free pages"""
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        return (page_count - free_pages) * page_size
+    
+    def archive(self, rows):
+        """Copy rows into this month's archive database.
+
+        Done before the rows are deleted, and idempotent, so a pass that
+        stops in between only repeats the copy next time.
+        """
+        os.makedirs(self.archive_folder, exist_ok=True)
+        month = datetime.now(timezone.utc).strftime('%Y-%m')
+        conn = open_connection(os.path.join(self.archive_folder, f'messages-{month}.db'),
+                               pragmas=STORAGE_PROFILES['durable'])
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    username TEXT NOT NULL,
+                    message_type TEXT NOT NULL,
+                    content TEXT,
+                    image_key TEXT,
+                    url TEXT,
+                    timestamp TIMESTAMP
+                )
+            ''')
+            conn.executemany(
+                'INSERT OR IGNORE INTO messages (id, user_id, username, message_type, content, image_key, url, timestamp) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(row['id'], row['user_id'], row['username'], row['message_type'], row['content'],
+                  row['image_key'], row['url'], row['timestamp']) for row in rows]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self.archived += len(rows)
+    
+    def remove_through(self, last_id):
+        """Delete messages up to last_id in one write and release free pages"""
+        def trim(conn):
+            deleted = conn.execute(DELETE_BEFORE_SQL, (last_id,)).rowcount
+            # Another process may have got here first
+            return deleted, record_deletion(conn, 'before', last_id) if deleted else None
+        
+        deleted, _ = db_writer.run(trim, after_commit=lambda result: publish_deletion(result[1]))
+        db_writer.run(self.release_pages)
+        return deleted
+    
+    def release_pages(self, conn):
+        """Truncate up to RETENTION_VACUUM_PAGES free pages off the file"""
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        # Each step of incremental_vacuum frees one page, and the sqlite3
+        # module steps a statement that returns no rows only once
+        for _ in range(min(free_pages, RETENTION_VACUUM_PAGES)):
+            conn.execute('PRAGMA incremental_vacuum')
+    
+    def stats(self):
+        return {
+            'passes': self.passes,
+            'removed': self.removed,
+            'archived': self.archived,
+            'last_run': self.last_run
         }
-        
-        function deleteUser(userId) {
-            if (confirm('Are you sure you want to delete this user?')) {
-                fetch('/api/admin/delete_user', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({user_id: userId})
-                })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.success) {
-                        loadAdminData();
-                    } else {
-                        alert('Error deleting user');
-                    }
-                });
-            }
+
+retention = RetentionManager()
+
+class PurgeJob:
+    """Progress of one admin bulk deletion"""
+    
+    def __init__(self, kind, target=None, username=None, was_banned=False):
+        self.id = uuid.uuid4().hex
+        self.kind = kind  # 'all' or 'user'
+        self.target = target  # user id for 'user'
+        self.username = username
+        self.was_banned = was_banned  # Restored if a 'user' purge keeps the account
+        self.account_deleted = False
+        self.status = 'running'
+        self.deleted = 0
+        self.error = None
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.finished_at = None
+        self.cancelled = threading.Event()
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'username': self.username,
+            'status': self.status,
+            'deleted': self.deleted,
+            'account_deleted': self.account_deleted,
+            'error': self.error,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
         }
+
+class PurgeManager:
+    """Runs admin bulk deletions as background jobs.
+
+    Each job deletes in chunks of chunk_size, every chunk its own short
+    write job, so chat writes commit in between and the admin's request
+    returns straight away. A job stops after the chunk in progress once
+    cancelled. Every chunk is announced as it commits: 'all' purges with a
+    'before' deletion up to the chunk's last message (messages sent during
+    the purge are kept), 'user' purges with a 'user_before' one. The last
+    of a user's messages go with the account, announced as a 'user'
+    deletion. The account is banned while its purge runs; if the purge is
+    cancelled or fails the account stays, with its earlier ban state.
+    """
+    
+    def __init__(self, chunk_size=PURGE_CHUNK, keep=PURGE_JOBS_KEPT):
+        self.chunk_size = chunk_size
+        self.keep = keep
+        self._jobs = {}
+        self._lock = threading.Lock()
+    
+    def start(self, kind, target=None, username=None, was_banned=False):
+        job = PurgeJob(kind, target, username, was_banned)
+        with self._lock:
+            self._jobs[job.id] = job
+            finished = [j for j in self._jobs.values() if j.status != 'running']
+            for old in finished[:max(len(finished) - self.keep, 0)]:
+                del self._jobs[old.id]
+        threading.Thread(target=self._run, args=(job,), name=f'purge-{job.id[:8]}', daemon=True).start()
+        return job
+    
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+    
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancelled.set()
+        return job
+    
+    def _run(self, job):
+        try:
+            if job.kind == 'all':
+                self._purge_all(job)
+            else:
+                self._purge_user(job)
+            job.status = 'cancelled' if job.cancelled.is_set() else 'done'
+        except Exception as e:
+            app.logger.exception('Purge %s failed', job.id)
+            job.status = 'failed'
+            job.error = str(e)
+        job.finished_at = datetime.now(timezone.utc).isoformat()
+    
+    def _purge_all(self, job):
+        with db_pool.connection() as conn:
+            last_id = conn.execute(LATEST_MESSAGE_ID_SQL).fetchone()[0]
+        
+        def delete_chunk(conn):
+            row = conn.execute(PURGE_CHUNK_END_SQL, (last_id, self.chunk_size - 1)).fetchone()
+            end = row['id'] if row else last_id
+            deleted = conn.execute(DELETE_BEFORE_SQL, (end,)).rowcount
+            return end, deleted, record_deletion(conn, 'before', end) if deleted else None
+        
+        deleted_through = 0
+        while deleted_through < last_id and not job.cancelled.is_set():
+            deleted_through, deleted, _ = db_writer.run(
+                delete_chunk, after_commit=lambda result: publish_deletion(result[2]))
+            job.deleted += deleted
+    
+    def _purge_user(self, job):
+        def delete_chunk(conn):
+            row = conn.execute(PURGE_USER_CHUNK_END_SQL, (job.target, self.chunk_size - 1)).fetchone()
+            if row is None:
+                return 0, None  # Less than a chunk left; it goes with the account
+            deleted = conn.execute(DELETE_USER_BEFORE_SQL, (job.target, row['id'])).rowcount
+            return deleted, record_deletion(conn, 'user_before', f"{row['id']}:{job.username}")
+        
+        def delete_user(conn):
+            job.deleted += conn.execute(DELETE_USER_MESSAGES_SQL, (job.target,)).rowcount
+            conn.execute('DELETE FROM users WHERE id = ?', (job.target,))
+            bump_users_version(conn)
+            return record_deletion(conn, 'user', job.username)
+        
+        try:
+            while not job.cancelled.is_set():
+                deleted, _ = db_writer.run(delete_chunk, after_commit=lambda result: publish_deletion(result[1]))
+                job.deleted += deleted
+                if not deleted:
+                    # Whatever they posted meanwhile goes with the account
+                    db_writer.run(delete_user, after_commit=publish_deletion)
+                    job.account_deleted = True
+                    return
+        finally:
+            if not job.account_deleted and not job.was_banned:
+                self._unban(job.target)
+    
+    def _unban(self, user_id):
+        def write(conn):
+            conn.execute('UPDATE users SET is_banned = 0 WHERE id = ?', (user_id,))
+            bump_users_version(conn)
         
-        function deleteAllMessages() {
-            if (confirm('Are you sure you want to delete ALL messages? This cannot be undone!')) {
-                fetch('/api/admin/delete_all_messages', {
-                    method: 'POST'
-                })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.success) {
-                        alert('All messages deleted successfully!');
-                        loadMessages();
-                    } else {
-                        alert('Error deleting messages');
-                    }
-                });
-            }
+        db_writer.run(write)
+        user_states.update(user_id, banned=False)
+
+purges = PurgeManager()
+
+class LocalBroker:
+    """Delivers committed chat events to this process's readers, in order.
+
+    Messages must reach readers in id order, and deletions in seq order,
+    or a client's cursor could step over one. Within a process that is
+    commit order, but events committed by other processes turn up late,
+    so delivery keeps its own cursors: anything at or below them is a
+    repeat and dropped, and anything past a gap waits while the gap is
+    read from the database (the gap committed first, so it is there).
+
+    This base class only sees its own process's writes. Subclasses also
+    listen for other processes' events and feed them through deliver().
+    """
+    
+    def __init__(self):
+        self.last_id = None
+        self.last_seq = None
+        self.delivered = 0
+        self.remote = 0
+        self.gaps_filled = 0
+        self._lock = threading.Lock()
+        self._started = False
+    
+    def start(self):
+        """Set the cursors to the current database state; call before writing"""
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            with db_pool.connection() as conn:
+                if self.last_id is None:
+                    self.last_id = conn.execute(LATEST_MESSAGE_ID_SQL).fetchone()[0]
+                if self.last_seq is None:
+                    self.last_seq = conn.execute(LATEST_DELETION_SQL).fetchone()[0]
+            self._listen()
+    
+    def _listen(self):
+        pass
+    
+    def publish(self, event, data):
+        """Announce an event this process committed"""
+        self.deliver(event, data)
+    
+    def deliver(self, event, data, remote=False):
+        with self._lock:
+            if event == 'message':
+                if self.last_id is None:
+                    self.last_id = data['id'] - 1
+                if data['id'] <= self.last_id:
+                    return
+                if data['id'] > self.last_id + 1:
+                    self.gaps_filled += self._catch_up(data['id'])
+                self.last_id = data['id']
+            else:
+                if self.last_seq is None:
+                    self.last_seq = data['seq'] - 1
+                if data['seq'] <= self.last_seq:
+                    return
+                if data['seq'] > self.last_seq + 1:
+                    self.gaps_filled += self._catch_up(last_seq=data['seq'])
+                self.last_seq = data['seq']
+            deliver_event(event, data)
+            self.delivered += 1
+            if remote:
+                self.remote += 1
+    
+    def _catch_up(self, last_id=2 ** 63 - 1, last_seq=2 ** 63 - 1):
+        """Deliver committed events past the cursors and below the given bounds.
+
+        Returns how many were delivered. The caller holds the lock.
+        """
+        delivered = 0
+        with db_pool.connection() as conn:
+            while True:
+                rows = conn.execute(MESSAGES_AFTER_SQL, (self.last_id, last_id, BROKER_CATCH_UP_BATCH)).fetchall()
+                for row in rows:
+                    self.last_id = row['id']
+                    deliver_event('message', serialize_message(row))
+                delivered += len(rows)
+                if len(rows) < BROKER_CATCH_UP_BATCH:
+                    break
+            while True:
+                rows = conn.execute(DELETIONS_AFTER_SQL, (self.last_seq, last_seq, BROKER_CATCH_UP_BATCH)).fetchall()
+                for row in rows:
+                    deletion = {'seq': row['seq'], 'scope': row['scope'], 'target': row['target']}
+                    self.last_seq = row['seq']
+                    deliver_event('delete', deletion)
+                delivered += len(rows)
+                if len(rows) < BROKER_CATCH_UP_BATCH:
+                    break
+        self.delivered += delivered
+        return delivered
+    
+    def stats(self):
+        return {
+            'type': type(self).__name__,
+            'last_id': self.last_id,
+            'last_seq': self.last_seq,
+            'delivered': self.delivered,
+            'remote': self.remote,
+            'gaps_filled': self.gaps_filled
         }
-        
-        // Allow Enter key to send messages
-        document.addEventListener('keypress', function(e) {
-            if (e.key === 'Enter' && (e.target.id === 'messageInput' || e.target.id === 'urlInput')) {
-                sendMessage();
+
+class SQLiteBroker(LocalBroker):
+    """Picks up other processes' events from the shared database file.
+
+    Needs nothing besides SQLite: a thread checks PRAGMA data_version every
+    poll interval and, after any commit, reads whatever messages and
+    deletions lie past the delivery cursors. Suits several worker processes
+    on one host.
+    """
+    
+    def __init__(self, database, interval=BROKER_POLL_INTERVAL):
+        super().__init__()
+        self.watcher = DataVersionWatcher(database, interval)
+    
+    def _listen(self):
+        threading.Thread(target=self._run, name='broker', daemon=True).start()
+    
+    def _run(self):
+        while True:
+            time.sleep(self.watcher.interval)
+            try:
+                if self.watcher.changed():
+                    with self._lock:
+                        self.remote += self._catch_up()
+            except Exception:
+                app.logger.exception('Broker poll failed')
+
+class RedisError(Exception):
+    pass
+
+class RedisConnection:
+    """Just enough of the Redis protocol (RESP) for PUBLISH and SUBSCRIBE"""
+    
+    def __init__(self, url, timeout=None):
+        parsed = urlparse(url)
+        self.sock = socket.create_connection((parsed.hostname or 'localhost', parsed.port or 6379), timeout=5)
+        self.sock.settimeout(timeout)
+        self.file = self.sock.makefile('rb')
+        if parsed.password:
+            self.command('AUTH', parsed.password)
+    
+    def send(self, *args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self.sock.sendall(b''.join(parts))
+    
+    def read(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('Redis closed the connection')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise RedisError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            return None if length < 0 else self.file.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(rest)
+            return None if length < 0 else [self.read() for _ in range(length)]
+        raise RedisError(f'Unexpected reply {line!r}')
+    
+    def command(self, *args):
+        self.send(*args)
+        return self.read()
+    
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+class RedisBroker(LocalBroker):
+    """Shares events between processes and hosts through Redis pub/sub.
+
+    Each event is published with this process's origin id; a subscriber
+    thread delivers everyone else's. Events lost while disconnected are
+    read back from the database on reconnect, and an event that arrives
+    ahead of one still in flight is ordered by the gap read above.
+    
+    publish() is called on the database writer thread, so it only queues
+    the event; a publisher thread sends it. While Redis is slow or away the
+    queue fills and further events are dropped, which subscribers elsewhere
+    make up from the database when they next hear anything.
+    """
+    
+    def __init__(self, url, channel=BROKER_CHANNEL, max_queued=BROKER_PUBLISH_QUEUE):
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self._outbox = queue.Queue(max_queued)
+        self.publish_errors = 0
+        self.publish_dropped = 0
+    
+    def publish(self, event, data):
+        super().publish(event, data)
+        payload = encode_json({'origin': self.origin, 'event': event, 'data': data})
+        try:
+            self._outbox.put_nowait(payload)
+        except queue.Full:
+            self.publish_dropped += 1
+    
+    def _listen(self):
+        threading.Thread(target=self._run, name='broker', daemon=True).start()
+        threading.Thread(target=self._send, name='broker-publisher', daemon=True).start()
+    
+    def _send(self):
+        conn = None
+        while True:
+            payload = self._outbox.get()
+            try:
+                if conn is None:
+                    conn = RedisConnection(self.url, timeout=5)
+                conn.command('PUBLISH', self.channel, payload)
+            except (OSError, RedisError):
+                self.publish_errors += 1
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                time.sleep(BROKER_RECONNECT_DELAY)
+    
+    def _run(self):
+        while True:
+            try:
+                conn = RedisConnection(self.url)
+                try:
+                    conn.command('SUBSCRIBE', self.channel)
+                    with self._lock:
+                        self.remote += self._catch_up()
+                    while True:
+                        reply = conn.read()
+                        if reply[0] != b'message':
+                            continue
+                        event = json.loads(reply[2])
+                        if event['origin'] != self.origin:
+                            self.deliver(event['event'], event['data'], remote=True)
+                finally:
+                    conn.close()
+            except Exception:
+                app.logger.exception('Broker subscription lost')
+            time.sleep(BROKER_RECONNECT_DELAY)
+    
+    def stats(self):
+        stats = super().stats()
+        stats['publish_errors'] = self.publish_errors
+        stats['publish_dropped'] = self.publish_dropped
+        stats['publish_queued'] = self._outbox.qsize()
+        return stats
+
+def create_broker(url=BROKER_URL):
+    if url == 'local':
+        return LocalBroker()
+    if url == 'sqlite':
+        return SQLiteBroker(DATABASE)
+    if url.startswith('redis://'):
+        return RedisBroker(url)
+    raise ValueError(f'Unknown broker {url!r}')
+
+broker = create_broker()
+
+@app.before_request
+def start_background_jobs():
+    broker.start()
+    retention.ensure_started()
+    user_states.load()
+
+@app.before_request
+def apply_user_state():
+    """Log out banned and deleted users and follow admin role changes"""
+    if 'user_id' not in session:
+        return
+    flags = user_states.get(session['user_id'])
+    if flags is None:
+        return
+    if flags & (USER_EXISTS | USER_BANNED) != USER_EXISTS:
+        session.clear()
+    elif bool(flags & USER_ADMIN) != bool(session.get('is_admin')):
+        session['is_admin'] = int(bool(flags & USER_ADMIN))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_LATENCY.observe((endpoint, request.method), time.perf_counter() - started)
+        REQUEST_COUNT.inc((endpoint, request.method, response.status_code))
+        if response.content_length is not None:
+            RESPONSE_SIZE.observe((endpoint,), response.content_length)
+    return response
+
+class RequestProfiler:
+    """Captures profiles of individual requests, kept in a bounded store.
+
+    Two ways in. A fraction of requests (profile_sample_rate), and any
+    request carrying a valid signed PROFILE_HEADER, run under cProfile and
+    are always kept. With profile_slow_ms set, a sampler thread instead
+    records the stack of every request in flight every few milliseconds,
+    which costs the requests nothing directly, and keeps the samples of
+    those that turn out slower than the threshold. Only one cProfile runs
+    at a time (from Python 3.12 it hooks every thread, and a second
+    enable() fails); a request that wants one meanwhile is sampled instead
+    and kept whatever its duration. cProfile captures download as pstats
+    or text, samples as collapsed stacks for flame graph tools.
+    """
+    
+    def __init__(self, keep=PROFILES_KEPT, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.profiles = deque(maxlen=keep)
+        self._active = {}  # thread id -> collapsed stack -> samples
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._sampler = None
+        self._cprofile_lock = threading.Lock()
+    
+    def serializer(self):
+        return URLSafeTimedSerializer(ensure_secret_key(), salt='request-profile')
+    
+    def token(self):
+        return self.serializer().dumps('profile')
+    
+    def wants_profile(self, header):
+        if header:
+            try:
+                self.serializer().loads(header, max_age=PROFILE_TOKEN_MAX_AGE)
+                return True
+            except BadSignature:
+                pass
+        rate = settings.get('profile_sample_rate')
+        return rate > 0 and random.random() < rate
+    
+    def start_cprofile(self):
+        """An enabled cProfile.Profile, or None while another is running"""
+        if not self._cprofile_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (a debugger, coverage) holds the hook
+            self._cprofile_lock.release()
+            return None
+        return profile
+    
+    def finish_cprofile(self, profile):
+        profile.disable()
+        self._cprofile_lock.release()
+    
+    def start_sampling(self):
+        """Sample the calling thread's stack until finish_sampling()"""
+        with self._lock:
+            self._active[threading.get_ident()] = {}
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+                self._sampler.start()
+            else:
+                self._wake.notify()
+    
+    def finish_sampling(self):
+        with self._lock:
+            return self._active.pop(threading.get_ident(), None)
+    
+    def _sample(self):
+        while True:
+            # Idle while nothing is sampled, and exit if that lasts
+            with self._lock:
+                if not self._active:
+                    self._wake.wait(PROFILE_SAMPLER_IDLE)
+                    if not self._active:
+                        self._sampler = None
+                        return
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in self._active.items():
+                    frame = frames.get(thread_id)
+                    names = []
+                    while frame is not None:
+                        code = frame.f_code
+                        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                        frame = frame.f_back
+                    stack = ';'.join(reversed(names))
+                    stacks[stack] = stacks.get(stack, 0) + 1
+    
+    def record(self, kind, duration, data):
+        profile = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'duration_ms': duration * 1000,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+        }
+        with self._lock:
+            self.profiles.append((profile, data))
+    
+    def find(self, profile_id):
+        with self._lock:
+            for profile, data in self.profiles:
+                if profile['id'] == profile_id:
+                    return profile, data
+        return None, None
+    
+    def summaries(self):
+        with self._lock:
+            return [profile for profile, _ in reversed(self.profiles)]
+
+request_profiler = RequestProfiler()
+
+@app.before_request
+def start_profiling():
+    if request.endpoint in PROFILE_EXCLUDED_ENDPOINTS:
+        return
+    wanted = request_profiler.wants_profile(request.headers.get(PROFILE_HEADER))
+    g.profile = request_profiler.start_cprofile() if wanted else None
+    if g.profile is None:
+        if not wanted and settings.get('profile_slow_ms') <= 0:
+            return
+        g.profile_sampling = 'keep' if wanted else 'slow'
+        request_profiler.start_sampling()
+    g.profile_started = time.perf_counter()
+
+@app.teardown_request
+def finish_profiling(exception):
+    started = g.pop('profile_started', None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    profile = g.pop('profile', None)
+    sampling = g.pop('profile_sampling', None)
+    if profile is not None:
+        request_profiler.finish_cprofile(profile)
+        request_profiler.record('cprofile', duration, profile)
+    elif sampling:
+        stacks = request_profiler.finish_sampling()
+        if stacks and (sampling == 'keep' or duration * 1000 >= settings.get('profile_slow_ms')):
+            request_profiler.record('sampled', duration, stacks)
+
+class CachedResponse:
+    """An encoded reply with a strong ETag and lazily built compressed forms"""
+    
+    def __init__(self, body):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.etag = hashlib.blake2b(self.body, digest_size=12).hexdigest()
+        self._encoded = {}
+    
+    def encoded(self, encoding):
+        data = self._encoded.get(encoding)
+        if data is None:
+            if encoding == 'br':
+                data = brotli.compress(self.body)
+            else:
+                data = gzip.compress(self.body, compresslevel=6)
+            self._encoded[encoding] = data
+        return data
+
+class ResponseCache:
+    """Encoded /api/messages replies, valid for one version of the room.
+
+    Replies only change when a message is sent or deleted, so between
+    writes every client with the same cursors gets the same bytes, and in
+    steady state nearly all clients share the same up-to-date cursors.
+    """
+    
+    def __init__(self, max_entries=RESPONSE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._version = None
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+    
+    def get(self, version, key, build):
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+        
+        entry = CachedResponse(build())
+        with self._lock:
+            if version == self._version and len(self._entries) < self.max_entries:
+                self._entries[key] = entry
+        return entry
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified
             }
-        });
-    </script>
-</body>
-</html>
-'''
+
+sync_responses = ResponseCache()
+
+def send_cached(entry, mimetype, cache_control, last_modified=None):
+    """Send a CachedResponse in the best encoding the client accepts, or a 304"""
+    encoding = None
+    if len(entry.body) >= COMPRESS_MIN_SIZE:
+        if brotli is not None and 'br' in request.accept_encodings:
+            encoding = 'br'
+        elif 'gzip' in request.accept_encodings:
+            encoding = 'gzip'
+    # Each encoding is a different representation, so gets its own ETag
+    etag = f'{entry.etag}-{encoding}' if encoding else entry.etag
+    
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        response = Response(entry.encoded(encoding) if encoding else entry.body, mimetype=mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept-Encoding')
+    return response
+
+def build_page():
+    """Fingerprint the static assets and render the page once.
+
+    Returns the rendered page, its last-modified time and a map of
+    fingerprinted asset name -> (CachedResponse, mimetype). Everything is
+    compressed up front, so serving the page does no template or
+    compression work.
+    """
+    assets = {}
+    urls = {}
+    mtimes = [os.path.getmtime(os.path.join(app.root_path, app.template_folder, 'index.html'))]
+    for name in STATIC_ASSETS:
+        path = os.path.join(app.static_folder, name)
+        with open(path, 'rb') as f:
+            entry = CachedResponse(f.read())
+        base, ext = os.path.splitext(name)
+        fingerprinted = f'{base}.{entry.etag[:12]}{ext}'
+        assets[fingerprinted] = (entry, mimetypes.guess_type(name)[0])
+        urls[name] = f'/assets/{fingerprinted}'
+        mtimes.append(os.path.getmtime(path))
+    
+    page = CachedResponse(app.jinja_env.get_template('index.html').render(asset_url=urls.__getitem__))
+    for entry in [page] + [entry for entry, _ in assets.values()]:
+        entry.encoded('gzip')
+        if brotli is not None:
+            entry.encoded('br')
+    last_modified = datetime.fromtimestamp(int(max(mtimes)), timezone.utc)
+    return page, last_modified, assets
+
+page, page_modified, page_assets = build_page()
 
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    # The page itself is revalidated on every load so it can point at new assets
+    return send_cached(page, 'text/html', 'no-cache', last_modified=page_modified)
+
+@app.route('/assets/<name>')
+def get_asset(name):
+    if name not in page_assets:
+        abort(404)
+    entry, mimetype = page_assets[name]
+    return send_cached(entry, mimetype, f'public, max-age={ASSET_CACHE_MAX_AGE}, immutable')
 
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -899,13 +2567,12 @@ def register():
         return jsonify({'success': False, 'message': 'Username and password are required'})
 
     try:
-        conn = get_db_connection()
-        password_hash = hash_password(password)
-        conn.execute('INSERT INTO users (username, password_hash, email) VALUES (?, ?, ?)', 
-                    (username, password_hash, email if email else None))
-        conn.commit()
-        conn.close()
+        password_hash = password_hasher.hash(password)
+        db_writer.execute('INSERT INTO users (username, password_hash, email) VALUES (?, ?, ?)', 
+                          (username, password_hash, email if email else None))
         return jsonify({'success': True})
+    except PasswordHasherBusy:
+        return password_busy_response()
     except sqlite3.IntegrityError:
         return jsonify({'success': False, 'message': 'Username already exists'})
     except Exception as e:
@@ -920,11 +2587,18 @@ def login():
     if not username or not password:
         return jsonify({'success': False, 'message': 'Username and password are required'})
     
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-    conn.close()
+    # Not held while hashing, so waiting logins cannot use up the pool
+    with db_pool.connection() as conn:
+        user = conn.execute(USER_BY_NAME_SQL, (username,)).fetchone()
+    try:
+        matches, new_hash = password_hasher.verify(password, user['password_hash'] if user else None)
+    except PasswordHasherBusy:
+        return password_busy_response()
     
-    if user and user['password_hash'] == hash_password(password):
+    if matches:
+        if new_hash:
+            db_writer.submit(lambda conn: conn.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                                                       (new_hash, user['id'], user['password_hash'])))
         if user['is_banned']:
             return jsonify({'success': False, 'message': 'Your account has been banned'})
         
@@ -950,91 +2624,533 @@ def check_login():
         })
     return jsonify({'logged_in': False})
 
+class AdmissionControl:
+    """Decides whether /api/send_message may queue another write.
+
+    New messages are shed while the writer is backed up: too many writes
+    queued, or writes queued while batches are slow to commit. Otherwise
+    the sender's user and address token buckets must both cover the
+    message; if either cannot, nothing is charged and the caller is told
+    how long until it could be.
+    """
+    
+    def __init__(self, max_keys=RATE_LIMIT_KEYS):
+        self.limits = {
+            'messages': (SEND_RATE, SEND_BURST),
+            'bytes': (UPLOAD_RATE, UPLOAD_BURST),
+        }
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # (limit, key) -> [tokens, last refill]
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.limited = {'messages': 0, 'bytes': 0}
+        self.shed = 0
+    
+    def overloaded(self):
+        depth = db_writer.queue_depth()
+        return depth >= SHED_QUEUE_DEPTH or (depth > 0 and db_writer.commit_time_avg >= SHED_COMMIT_TIME)
+    
+    def admit(self, user_id, address, size):
+        """Return 0 and charge the buckets, or the seconds to wait before retrying"""
+        if self.overloaded():
+            self.shed += 1
+            return SHED_RETRY_AFTER
+        
+        now = time.monotonic()
+        charges = []
+        wait = 0
+        worst = None
+        with self._lock:
+            for key, scale in ((f'user:{user_id}', 1), (f'addr:{address}', ADDRESS_LIMIT_FACTOR)):
+                for limit, cost in (('messages', 1), ('bytes', size)):
+                    rate, burst = self.limits[limit]
+                    rate, burst = rate * scale, burst * scale
+                    bucket = self._buckets.pop((limit, key), None) or [burst, now]
+                    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                    bucket[1] = now
+                    self._buckets[(limit, key)] = bucket
+                    cost = min(cost, burst)
+                    if bucket[0] < cost and (cost - bucket[0]) / rate > wait:
+                        wait = (cost - bucket[0]) / rate
+                        worst = limit
+                    charges.append((bucket, cost))
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            if worst:
+                self.limited[worst] += 1
+                return wait
+            for bucket, cost in charges:
+                bucket[0] -= cost
+            self.admitted += 1
+            return 0
+    
+    def stats(self):
+        return {
+            'admitted': self.admitted,
+            'limited': dict(self.limited),
+            'shed': self.shed,
+            'buckets': len(self._buckets)
+        }
+
+admission = AdmissionControl()
+
 @app.route('/api/send_message', methods=['POST'])
 def send_message():
     if 'user_id' not in session:
         return jsonify({'success': False, 'message': 'Not logged in'})
     
-    message_type = request.form.get('message_type')
-    content = request.form.get('content', '').strip()
-    url = request.form.get('url', '').strip()
-    image_data = None
-    
-    # Handle image upload
-    if 'image' in request.files:
-        image_file = request.files['image']
-        if image_file and image_file.filename:
-            # Check file size
-            max_size = int(get_setting('max_image_size'))
-            image_file.seek(0, 2)  # Seek to end
-            file_size = image_file.tell()
-            image_file.seek(0)  # Reset to beginning
-            
-            if file_size > max_size:
-                return jsonify({'success': False, 'message': f'Image too large. Max size: {max_size/1024}KB'})
-            
-            # Convert to base64
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
+    # Reject oversized uploads before reading the body
+    max_size = get_setting('max_image_size')
+    too_large = {'success': False, 'message': f'Image too large. Max size: {max_size/1024}KB'}
+    if request.content_length and request.content_length > max_request_size():
+        return jsonify(too_large), 413
+    
+    # Charged by declared size; a body sent without one counts as the largest allowed
+    retry_after = admission.admit(session['user_id'], request.remote_addr,
+                                  request.content_length or max_request_size())
+    if retry_after:
+        response = jsonify({'success': False, 'message': 'Too many messages, please slow down'})
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response, 429
+    
+    # Parsing the form streams any image into the blob store's temp folder
+    try:
+        message_type = request.form.get('message_type')
+        content = request.form.get('content', '').strip()
+        url = request.form.get('url', '').strip()
+        image_file = request.files.get('image')
+    except RequestEntityTooLarge:
+        return jsonify(too_large), 413
+    except UnsupportedMediaType:
+        return jsonify({'success': False, 'message': 'Unsupported image type'}), 415
+    
+    upload = None
+    if image_file and image_file.filename and image_file.stream.size:
+        upload = image_file.stream
+        if upload.content_type() is None:
+            return jsonify({'success': False, 'message': 'Unsupported image type'}), 415
     
     # Validate message content
     if message_type == 'text' and not content:
         return jsonify({'success': False, 'message': 'Message content required'})
-    elif message_type == 'image' and not image_data:
+    elif message_type == 'image' and not upload:
         return jsonify({'success': False, 'message': 'Image required'})
     elif message_type == 'url' and not url:
         return jsonify({'success': False, 'message': 'URL required'})
-    elif message_type == 'text+image' and not content and not image_data:
+    elif message_type == 'text+image' and not content and not upload:
         return jsonify({'success': False, 'message': 'Text or image required'})
     
     try:
-        conn = get_db_connection()
-        conn.execute('''
-            INSERT INTO messages (user_id, username, message_type, content, image_data, url)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (session['user_id'], session['username'], message_type, content or None, image_data, url or None))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True})
+        image_key = None
+        if upload:
+            image_key = upload.commit()
+        user_id = session['user_id']
+        username = session['username']
+        
+        def insert_message(conn):
+            if image_key:
+                record_image(conn, image_key, upload.content_type(), upload.size)
+            cursor = conn.execute('''
+                INSERT INTO messages (user_id, username, message_type, content, image_key, url)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, username, message_type, content or None, image_key, url or None))
+            message = conn.execute(MESSAGE_BY_ID_SQL, (cursor.lastrowid,)).fetchone()
+            return serialize_message(message)
+        
+        db_writer.run(insert_message, after_commit=publish_message)
     except Exception as e:
         return jsonify({'success': False, 'message': 'Failed to send message'})
+    
+    # The message is committed; rendering failures are only logged
+    if image_key:
+        image_variants.submit(image_key)
+    return jsonify({'success': True})
+
+def publish_message(message):
+    """Announce a committed message to readers and streaming clients"""
+    broker.publish('message', message)
+
+def publish_deletion(deletion):
+    """Announce a committed deletion to readers and streaming clients"""
+    if deletion:
+        broker.publish('delete', deletion)
+
+def deliver_event(event, data):
+    """Hand an event, from this process or another, to local readers"""
+    if event == 'message':
+        recent_messages.append(data)
+        message_hub.publish('message', data, event_id=data['id'])
+    else:
+        recent_messages.apply_deletion(data)
+        message_hub.publish('delete', data)
+
+def record_deletion(conn, scope, target=None):
+    """Insert a message_deletions row and return it as sent to clients"""
+    cursor = conn.execute('INSERT INTO message_deletions (scope, target) VALUES (?, ?)', (scope, target))
+    return {'seq': cursor.lastrowid, 'scope': scope, 'target': target}
+
+def serialize_message(msg):
+    """Convert a messages row into its API representation"""
+    return {
+        'id': msg['id'],
+        'username': msg['username'],
+        'message_type': msg['message_type'],
+        'content': msg['content'],
+        'image_url': '/images/' + msg['image_key'] if msg['image_key'] else None,
+        'thumb_url': f'/images/{msg["image_key"]}/thumb' if msg['image_key'] else None,
+        'display_url': f'/images/{msg["image_key"]}/display' if msg['image_key'] else None,
+        'url': msg['url'],
+        'timestamp': msg['timestamp']
+    }
 
 @app.route('/api/messages')
 def get_messages():
+    """Return messages newer than ?after_id= plus deletions newer than ?deleted_after=.
+
+    Without after_id (or when the client has fallen too far behind) the latest
+    page is returned with reset=True and the client replaces what it has.
+    """
     if 'user_id' not in session:
-        return jsonify({'messages': []})
-    
-    conn = get_db_connection()
-    messages = conn.execute('''
-        SELECT * FROM messages 
-        ORDER BY timestamp DESC 
-        LIMIT 50
-    ''').fetchall()
-    conn.close()
+        return jsonify({'messages': [], 'last_id': 0, 'deletions': [], 'deletion_seq': 0, 'reset': True})
     
-    messages_list = []
-    for msg in reversed(messages):
-        messages_list.append({
-            'id': msg['id'],
-            'username': msg['username'],
-            'message_type': msg['message_type'],
-            'content': msg['content'],
-            'image_data': msg['image_data'],
-            'url': msg['url'],
-            'timestamp': msg['timestamp']
-        })
+    after_id = request.args.get('after_id', type=int)
+    deleted_after = request.args.get('deleted_after', 0, type=int)
+    
+    entry = sync_responses.get(
+        recent_messages.version, (after_id, deleted_after),
+        lambda: recent_messages.sync(after_id, deleted_after, get_db)
+    )
     
-    return jsonify({'messages': messages_list})
+    response = send_cached(entry, 'application/json', 'private, no-cache')
+    if response.status_code == 304:
+        sync_responses.not_modified += 1
+    return response
 
-@app.route('/api/admin/settings')
-def admin_get_settings():
+@app.route('/api/messages/history')
+def get_message_history():
+    """Return the page of messages just older than ?before_id=, oldest first.
+
+    Pages are keyed on the message id rather than an offset, so each one is
+    a single seek into the primary key however far back it is.
+    """
+    if 'user_id' not in session:
+        return jsonify({'messages': [], 'has_more': False})
+    
+    before_id = request.args.get('before_id', type=int)
+    limit = min(max(request.args.get('limit', MESSAGE_PAGE_SIZE, type=int), 1), MAX_HISTORY_PAGE_SIZE)
+    if before_id is None:
+        return jsonify({'error': 'before_id is required'}), 400
+    
+    conn = get_db()
+    rows = conn.execute(HISTORY_SQL, (before_id, limit + 1)).fetchall()
+    return jsonify({
+        'messages': [serialize_message(msg) for msg in reversed(rows[:limit])],
+        'has_more': len(rows) > limit
+    })
+
+def fts_query(text):
+    """Turn free text into an FTS5 query matching every word.
+
+    Each word is quoted so operators and punctuation are taken literally;
+    a trailing * is kept as a prefix search.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+def search_messages(conn, query, username=None, since=None, until=None, order='rank', cursor=None, limit=SEARCH_PAGE_SIZE):
+    """Return (rows, next cursor) for messages matching query.
+
+    order is 'rank' (best bm25 score first) or 'recent' (newest first). The
+    cursor is the sort key of the last row returned, so each page continues
+    from it instead of skipping an offset. Rows carry a 'highlighted' column
+    with matches wrapped in \\x02 and \\x03.
+    """
+    sql = '''
+        SELECT m.*, messages_fts.rank AS score,
+               highlight(messages_fts, 0, char(2), char(3)) AS highlighted
+        FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH ?
+    '''
+    params = [query]
+    if username:
+        sql += ' AND m.username = ?'
+        params.append(username)
+    if since:
+        sql += ' AND m.timestamp >= ?'
+        params.append(since)
+    if until:
+        sql += ' AND m.timestamp < ?'
+        params.append(until)
+    
+    if order == 'recent':
+        if cursor:
+            sql += ' AND messages_fts.rowid < ?'
+            params.append(int(cursor))
+        sql += ' ORDER BY messages_fts.rowid DESC'
+    else:
+        if cursor:
+            score, last_id = cursor.split(':')
+            sql += ' AND (messages_fts.rank > ? OR (messages_fts.rank = ? AND messages_fts.rowid > ?))'
+            params.extend([float(score), float(score), int(last_id)])
+        sql += ' ORDER BY messages_fts.rank, messages_fts.rowid'
+    sql += ' LIMIT ?'
+    params.append(limit + 1)
+    
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = str(last['id']) if order == 'recent' else f'{last["score"]!r}:{last["id"]}'
+    return rows, next_cursor
+
+def highlight_html(text):
+    """Escape highlighted content and mark the matches with <mark>"""
+    return html.escape(text or '').replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+def search_time(value):
+    """Accept ISO 8601 times and compare them the way SQLite stores timestamps"""
+    if not value:
+        return None
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+@app.route('/api/search')
+def search():
+    """Full-text message search for moderators.
+
+    Takes ?q= plus optional username, since, until (ISO 8601, UTC), order
+    ('rank' or 'recent'), limit and the cursor from the previous page.
+    """
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    query = fts_query(request.args.get('q', ''))
+    if not query:
+        return jsonify({'error': 'Search text is required'}), 400
+    
+    order = request.args.get('order', 'rank')
+    if order not in ('rank', 'recent'):
+        return jsonify({'error': 'order must be rank or recent'}), 400
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), MAX_SEARCH_PAGE_SIZE)
+    
+    try:
+        since = search_time(request.args.get('since'))
+        until = search_time(request.args.get('until'))
+        rows, next_cursor = search_messages(
+            get_db(), query,
+            username=request.args.get('username'), since=since, until=until,
+            order=order, cursor=request.args.get('cursor'), limit=limit
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid time range or cursor'}), 400
+    
+    results = []
+    for row in rows:
+        result = serialize_message(row)
+        result['highlighted'] = highlight_html(row['highlighted'])
+        result['score'] = row['score']
+        results.append(result)
+    return jsonify({'results': results, 'next_cursor': next_cursor})
+
+@app.route('/api/stream')
+def stream_messages():
+    """Server-sent event stream of new messages and deletions"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    # Subscribe before responding so nothing published after the client's
+    # catch-up request is missed
+    subscriber = message_hub.subscribe()
+    user_id = session['user_id']
+    
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'.encode('utf-8')
+            while not subscriber.closed or not subscriber.queue.empty():
+                try:
+                    frame = subscriber.queue.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    frame = b': keepalive\n\n'
+                # Checked per frame so a ban or deletion cuts the stream off at once
+                if not user_states.allowed(user_id):
+                    break
+                yield frame
+        finally:
+            message_hub.unsubscribe(subscriber)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/images/<key>')
+def get_image(key):
+    """Serve a stored image; the key is its content hash so it is cached forever"""
+    if not IMAGE_KEY_RE.match(key):
+        abort(404)
+    conn = get_db()
+    image = conn.execute(IMAGE_SQL, (key,)).fetchone()
+    if not image or not os.path.exists(image_path(key)):
+        abort(404)
+    
+    response = send_file(os.path.abspath(image_path(key)), mimetype=image['content_type'],
+                         conditional=True, etag=key, max_age=IMAGE_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+@app.route('/images/<key>/<variant>')
+def get_image_variant(key, variant):
+    """Serve a downscaled copy of an image, or the original until it is ready"""
+    if not IMAGE_KEY_RE.match(key) or variant not in IMAGE_VARIANTS:
+        abort(404)
+    conn = get_db()
+    row = conn.execute(IMAGE_VARIANT_SQL, (key, variant)).fetchone()
+    path = os.path.join(variant_dir(key), row['filename']) if row else None
+    if path is None or not os.path.exists(path):
+        # Stand-in only: revalidated each time so the variant replaces it
+        response = get_image(key)
+        response.cache_control.public = False
+        response.cache_control.immutable = False
+        response.cache_control.max_age = None
+        response.cache_control.no_cache = True
+        response.expires = None
+        return response
+    
+    response = send_file(os.path.abspath(path), mimetype=row['content_type'],
+                         conditional=True, etag=f'{key}-{variant}', max_age=IMAGE_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+@app.route('/api/admin/stats')
+def admin_get_stats():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    return jsonify(collect_stats())
+
+def collect_stats():
+    """Runtime statistics of each subsystem, as shown to admins"""
+    return {
+        'db_pool': db_pool.stats(),
+        'db_writer': db_writer.stats(),
+        'recent_cache': recent_messages.stats(),
+        'response_cache': sync_responses.stats(),
+        'image_variants': image_variants.stats(),
+        'retention': retention.stats(),
+        'broker': broker.stats(),
+        'admission': admission.stats(),
+        'passwords': password_hasher.stats(),
+        'user_states': user_states.stats(),
+        'stream': {
+            'subscribers': message_hub.subscriber_count(),
+            'dropped': message_hub.dropped
+        }
+    }
+
+def stats_gauges(stats, prefix='chat'):
+    """Flatten the numbers in collect_stats() into (name, value) pairs"""
+    for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        if isinstance(value, dict):
+            yield from stats_gauges(value, name)
+        elif isinstance(value, (int, float)):
+            yield name, float(value)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of this process's metrics"""
+    authorized = session.get('is_admin') and 'user_id' in session
+    if METRICS_TOKEN and request.headers.get('Authorization') == f'Bearer {METRICS_TOKEN}':
+        authorized = True
+    if not authorized:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, value in stats_gauges(collect_stats()):
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/admin/profiling', methods=['GET', 'POST'])
+def admin_profiling():
     if 'user_id' not in session or not session.get('is_admin'):
         return jsonify({'error': 'Unauthorized'}), 403
     
-    max_image_size = get_setting('max_image_size')
+    if request.method == 'POST':
+        data = request.get_json()
+        try:
+            if data.get('sample_rate') is not None:
+                if not 0 <= float(data['sample_rate']) <= 1:
+                    raise ValueError
+                update_setting('profile_sample_rate', data['sample_rate'])
+            if data.get('slow_ms') is not None:
+                if int(data['slow_ms']) < 0:
+                    raise ValueError
+                update_setting('profile_slow_ms', data['slow_ms'])
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'Invalid profiling settings'})
+    
     return jsonify({
-        'max_image_size': int(max_image_size) if max_image_size else 1024*1024
+        'sample_rate': get_setting('profile_sample_rate'),
+        'slow_ms': get_setting('profile_slow_ms'),
+        'header': PROFILE_HEADER,
+        'token': request_profiler.token(),
+        'profiles': request_profiler.summaries()
     })
 
+@app.route('/api/admin/profiles/<profile_id>')
+def admin_get_profile(profile_id):
+    """Download a captured profile.
+
+    ?format=pstats (binary, for pstats/snakeviz) or text for cProfile
+    captures; collapsed stacks (one 'a;b;c count' line each) for sampled.
+    """
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    profile, data = request_profiler.find(profile_id)
+    if profile is None:
+        return jsonify({'error': 'Not found'}), 404
+    
+    fmt = request.args.get('format', 'collapsed' if profile['kind'] == 'sampled' else 'text')
+    if profile['kind'] == 'sampled' and fmt == 'collapsed':
+        body = ''.join(f'{stack} {count}\n' for stack, count in sorted(data.items()))
+        return Response(body, mimetype='text/plain')
+    if profile['kind'] == 'cprofile' and fmt == 'text':
+        out = io.StringIO()
+        pstats.Stats(data, stream=out).sort_stats('cumulative').print_stats(100)
+        return Response(out.getvalue(), mimetype='text/plain')
+    if profile['kind'] == 'cprofile' and fmt == 'pstats':
+        data.create_stats()
+        return Response(marshal.dumps(data.stats), mimetype='application/octet-stream', headers={
+            'Content-Disposition': f'attachment; filename={profile_id}.pstats'
+        })
+    return jsonify({'error': f'No {fmt} format for {profile["kind"]} profiles'}), 400
+
+@app.route('/api/admin/settings')
+def admin_get_settings():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    result = {'max_image_size': get_setting('max_image_size')}
+    for key in RETENTION_SETTINGS:
+        result[key] = get_setting(key)
+    return jsonify(result)
+
 @app.route('/api/admin/update_settings', methods=['POST'])
 def admin_update_settings():
     if 'user_id' not in session or not session.get('is_admin'):
@@ -1043,8 +3159,23 @@ def admin_update_settings():
     data = request.get_json()
     max_image_size = data.get('max_image_size')
     
-    if max_image_size:
-        update_setting('max_image_size', str(max_image_size))
+    if max_image_size is not None:
+        try:
+            if int(max_image_size) <= 0:
+                raise ValueError
+            update_setting('max_image_size', max_image_size)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'Invalid max image size'})
+    
+    for key in RETENTION_SETTINGS:
+        if data.get(key) is None:
+            continue
+        try:
+            if int(data[key]) < 0:
+                raise ValueError
+            update_setting(key, data[key])
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': f'Invalid {key}'})
     
     return jsonify({'success': True})
 
@@ -1053,9 +3184,8 @@ def admin_get_users():
     if 'user_id' not in session or not session.get('is_admin'):
         return jsonify({'error': 'Unauthorized'}), 403
     
-    conn = get_db_connection()
-    users = conn.execute('SELECT id, username, email, created_at, is_banned, is_admin FROM users ORDER BY created_at DESC').fetchall()
-    conn.close()
+    conn = get_db()
+    users = conn.execute(USERS_LIST_SQL).fetchall()
     
     users_list = []
     for user in users:
@@ -1076,17 +3206,22 @@ def admin_toggle_ban():
         return jsonify({'error': 'Unauthorized'}), 403
     
     data = request.get_json()
-    user_id = data.get('user_id')
-    ban = data.get('ban')
-    
     try:
-        conn = get_db_connection()
+        user_id = int(data.get('user_id'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid user id'})
+    ban = 1 if data.get('ban') else 0
+    
+    def write(conn):
         conn.execute('UPDATE users SET is_banned = ? WHERE id = ?', (ban, user_id))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True})
+        bump_users_version(conn)
+    
+    try:
+        db_writer.run(write)
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
+    user_states.update(user_id, banned=ban)
+    return jsonify({'success': True})
 
 @app.route('/api/admin/delete_user', methods=['POST'])
 def admin_delete_user():
@@ -1094,36 +3229,67 @@ def admin_delete_user():
         return jsonify({'error': 'Unauthorized'}), 403
     
     data = request.get_json()
-    user_id = data.get('user_id')
+    try:
+        user_id = int(data.get('user_id'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid user id'})
     
     # Don't allow deleting admin user
     if user_id == session['user_id']:
         return jsonify({'success': False, 'message': 'Cannot delete your own account'})
     
-    try:
-        conn = get_db_connection()
-        conn.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
-        conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
+    user = get_db().execute(USER_BY_ID_SQL, (user_id,)).fetchone()
+    if not user:
+        return jsonify({'success': False, 'message': 'User not found'})
+    
+    # Locked out at once; the account itself goes once its messages have
+    def lock_out(conn):
+        was_banned = conn.execute('SELECT is_banned FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+        conn.execute('UPDATE users SET is_banned = 1 WHERE id = ?', (user_id,))
+        bump_users_version(conn)
+        return bool(was_banned)
+    
+    was_banned = db_writer.run(lock_out)
+    user_states.update(user_id, banned=True)
+    job = purges.start('user', user_id, user['username'], was_banned)
+    return jsonify({'success': True, 'job': job.to_dict()}), 202
 
 @app.route('/api/admin/delete_all_messages', methods=['POST'])
 def admin_delete_all_messages():
     if 'user_id' not in session or not session.get('is_admin'):
         return jsonify({'error': 'Unauthorized'}), 403
     
-    try:
-        conn = get_db_connection()
-        conn.execute('DELETE FROM messages')
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
+    job = purges.start('all')
+    return jsonify({'success': True, 'job': job.to_dict()}), 202
+
+@app.route('/api/admin/purges')
+def admin_get_purges():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    return jsonify({'jobs': [job.to_dict() for job in purges.jobs()]})
+
+@app.route('/api/admin/purges/<job_id>')
+def admin_get_purge(job_id):
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    job = purges.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({'job': job.to_dict()})
+
+@app.route('/api/admin/purges/<job_id>/cancel', methods=['POST'])
+def admin_cancel_purge(job_id):
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    job = purges.cancel(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Not found'}), 404
+    return jsonify({'success': True, 'job': job.to_dict()})
 
+# Development server. For production use the ASGI entry point in asgi.py
 if __name__ == '__main__':
     init_db()
     port = int(os.environ.get('PORT', 5000))
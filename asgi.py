@@ -0,0 +1,285 @@
+"""ASGI entry point: serves the chat on an event loop.
+
+Run it in production with an ASGI server, for example:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 4
+
+Connections are held by the event loop rather than by a thread each, so a
+process can keep thousands of idle clients. /api/check_login and warm
+/api/messages polls are answered on the loop itself, and /api/stream is
+served natively from the message hub. Request bodies are read on the loop
+before any thread is involved, so slow uploads do not pin one. Everything
+else, including the database work behind /api/send_message, runs the Flask
+app as-is on a bounded thread pool, so every route behaves exactly as under
+the threaded server. Logins and registrations get a pool of their own, as
+they mostly wait on password hashing and must not hold the chat's threads.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from flask import session
+
+import app as chat
+
+# Threads for blocking work; no more than the connection pool can serve at once
+ASGI_WORKERS = int(os.environ.get('ASGI_WORKERS', chat.DB_POOL_SIZE))
+
+# Paths served from auth_executor, sized to the requests the password hasher admits
+AUTH_PATHS = {'/api/login', '/api/register'}
+
+executor = ThreadPoolExecutor(ASGI_WORKERS, thread_name_prefix='asgi')
+auth_executor = ThreadPoolExecutor(chat.PASSWORD_WORKERS + chat.PASSWORD_QUEUE_DEPTH, thread_name_prefix='asgi-auth')
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class AsyncSubscriber:
+    """Message hub subscriber whose events are awaited on an event loop.
+
+    The hub offers frames from the writer thread; they are handed to the
+    loop with call_soon_threadsafe. offered and taken are each only changed
+    by one side, so their difference is a safe count of queued frames.
+    """
+
+    def __init__(self, loop, maxsize=chat.STREAM_QUEUE_SIZE):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.queue = asyncio.Queue()
+        self.offered = 0
+        self.taken = 0
+        self.closed = False
+
+    def offer(self, frame):
+        try:
+            if self.offered - self.taken >= self.maxsize:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, None)  # wakes the stream to end it
+                return False
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, frame)
+        except RuntimeError:  # the loop has closed
+            return False
+        self.offered += 1
+        return True
+
+    async def get(self):
+        """The next frame, or None once the hub has dropped this subscriber"""
+        frame = await self.queue.get()
+        if frame is not None:
+            self.taken += 1
+        return frame
+
+
+def build_environ(scope, body, content_length):
+    """Translate an ASGI HTTP scope into a WSGI environ"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name not in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):  # the body is passed whole
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    if content_length is not None:
+        environ['CONTENT_LENGTH'] = str(content_length)
+    return environ
+
+
+async def read_body(scope, receive):
+    """Read the request body on the loop.
+
+    Returns (file, length). A body larger than the app accepts is not kept:
+    the app gets an empty one with the oversized length, and answers with
+    its usual 413.
+    """
+    declared = None
+    for name, value in scope['headers']:
+        if name == b'content-length':
+            declared = int(value)
+    limit = chat.max_request_size()
+    if declared is not None and declared > limit:
+        return BytesIO(), declared
+
+    body = tempfile.SpooledTemporaryFile(max_size=chat.MAX_FORM_MEMORY, dir=chat.UPLOAD_TMP_FOLDER)
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            body.close()
+            return BytesIO(), size
+        body.write(chunk)
+        if not message.get('more_body', False):
+            break
+    body.seek(0)
+    return body, (size if size or declared is not None else None)
+
+
+def start_wsgi(environ):
+    """Run the Flask app up to its response; returns (status, headers, body iterable)"""
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    result = chat.app.wsgi_app(environ, start_response)
+    return started[0], started[1], result
+
+
+async def run_wsgi(send, environ, blocking, pool=executor):
+    """Serve a request with the Flask app, in the thread pool if blocking"""
+    loop = asyncio.get_running_loop()
+    if blocking:
+        status, headers, result = await loop.run_in_executor(pool, start_wsgi, environ)
+    else:
+        status, headers, result = start_wsgi(environ)
+
+    await send({
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    try:
+        if isinstance(result, (list, tuple)) or not blocking:
+            for chunk in result:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        else:
+            # File responses and generators may block on every chunk
+            chunks = iter(result)
+            while True:
+                chunk = await loop.run_in_executor(pool, next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        if hasattr(result, 'close'):
+            if blocking:
+                await loop.run_in_executor(pool, result.close)
+            else:
+                result.close()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream_messages(send, receive, environ):
+    """/api/stream without a thread per client; same events as the Flask route"""
+    with chat.app.request_context(environ):
+        user_id = session.get('user_id')
+    if user_id is None or not chat.user_states.allowed(user_id):
+        await run_wsgi(send, environ, blocking=False)  # the route's 401
+        return
+
+    # Subscribe before responding so nothing published after the client's
+    # catch-up request is missed
+    subscriber = AsyncSubscriber(asyncio.get_running_loop())
+    chat.message_hub.subscribe(subscriber)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+        while not disconnected.done():
+            getter = asyncio.ensure_future(subscriber.get())
+            await asyncio.wait({getter, disconnected}, timeout=chat.STREAM_KEEPALIVE,
+                               return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                frame = getter.result()
+                if frame is None:
+                    break
+            else:
+                getter.cancel()
+                if disconnected.done():
+                    break
+                frame = b': keepalive\n\n'
+            if not chat.user_states.allowed(user_id):
+                break
+            await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    except OSError:
+        pass  # the client went away mid-send
+    finally:
+        chat.message_hub.unsubscribe(subscriber)
+        disconnected.cancel()
+
+
+async def lifespan(receive, send):
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await loop.run_in_executor(executor, chat.init_db)
+            await loop.run_in_executor(executor, chat.start_background_jobs)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            auth_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    try:
+        if path == '/api/stream':
+            await stream_messages(send, receive, build_environ(scope, BytesIO(), None))
+            return
+        body, content_length = await read_body(scope, receive)
+    except ClientDisconnected:
+        return
+
+    environ = build_environ(scope, body, content_length)
+    try:
+        if path == '/api/check_login':
+            await run_wsgi(send, environ, blocking=False)
+        elif path == '/api/messages' and chat.recent_messages.warm:
+            await run_wsgi(send, environ, blocking=False)
+        elif path in AUTH_PATHS:
+            await run_wsgi(send, environ, blocking=True, pool=auth_executor)
+        else:
+            await run_wsgi(send, environ, blocking=True)
+    finally:
+        body.close()
@@ -0,0 +1,338 @@
+"""Load test for a single chat node.
+
+Starts the app against a throwaway database, seeds it, then runs pollers of
+/api/messages alongside posters of text and image messages for a fixed time:
+
+    python bench.py --pollers 200 --posters 10 --duration 30
+    python bench.py --server asgi --output after.json --compare before.json
+    python bench.py --login-burst 1000
+
+Reports throughput and p50/p95/p99 latency per endpoint plus the database
+size and the server's resident memory, and saves them as JSON so runs can
+be compared. Rate limits are raised out of the way unless --keep-limits.
+With --login-burst, a third of the way in that many logins are fired at
+once; chat requests made while they run are reported separately, marked
+"during logins", to compare against those made outside the burst.
+"""
+import argparse
+import gzip
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'bench-password'
+
+# Run in the server's working directory to build and fill its database
+SEED_SCRIPT = '''
+import sys
+import app
+users, messages, password = int(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+app.init_db()
+conn = app.open_connection(app.DATABASE)
+password_hash = app.hash_password(password)
+conn.executemany('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                 [(f'bench{i}', password_hash) for i in range(users)])
+conn.executemany(
+    "INSERT INTO messages (user_id, username, message_type, content) "
+    "SELECT id, username, 'text', ? FROM users WHERE username = ?",
+    ((f'seed message {i} ' + 'lorem ipsum ' * (i % 8), f'bench{i % users}') for i in range(messages))
+)
+conn.commit()
+'''
+
+
+class Client:
+    """One keep-alive HTTP connection with a session cookie"""
+
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        self.cookie = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        self.conn.request(method, path, body, headers)
+        response = self.conn.getresponse()
+        data = response.read()
+        if response.getheader('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return response.status, data
+
+    def login(self, username):
+        status, data = self.request('POST', '/api/login', json.dumps({'username': username, 'password': PASSWORD}),
+                                    {'Content-Type': 'application/json'})
+        if status != 200 or not json.loads(data).get('success'):
+            raise RuntimeError(f'Login as {username} failed: {data[:200]!r}')
+
+
+class Recorder:
+    """Latencies and failures per endpoint, shared by all workers"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.login_burst = threading.Event()
+
+    def record(self, name, seconds, ok):
+        if self.login_burst.is_set() and name != 'POST /api/login':
+            name += ' during logins'
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def multipart(fields, image):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    if image is not None:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="bench.png"\r\n'
+                     f'Content-Type: image/png\r\n\r\n'.encode() + image + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def poller(client, recorder, stop, interval):
+    after_id, deleted_after = None, 0
+    while not stop.is_set():
+        path = '/api/messages'
+        if after_id is not None:
+            path += f'?after_id={after_id}&deleted_after={deleted_after}'
+        started = time.perf_counter()
+        status, data = client.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+        recorder.record('GET /api/messages', time.perf_counter() - started, status == 200)
+        if status == 200:
+            reply = json.loads(data)
+            after_id, deleted_after = reply['last_id'], reply['deletion_seq']
+        stop.wait(interval)
+
+
+def poster(client, recorder, stop, interval, image_ratio, image_size):
+    while not stop.is_set():
+        if random.random() < image_ratio:
+            name = 'POST /api/send_message (image)'
+            image = b'\x89PNG\r\n\x1a\n' + os.urandom(image_size)
+            body, content_type = multipart({'message_type': 'image'}, image)
+        else:
+            name = 'POST /api/send_message (text)'
+            body, content_type = multipart({'message_type': 'text', 'content': f'bench {uuid.uuid4().hex}'}, None)
+        started = time.perf_counter()
+        status, data = client.request('POST', '/api/send_message', body, {'Content-Type': content_type})
+        recorder.record(name, time.perf_counter() - started, status == 200 and b'"success":true' in data.replace(b' ', b''))
+        stop.wait(interval)
+
+
+def login_burst(port, recorder, stop, delay, count, concurrency, users):
+    """After delay seconds, log in count times from concurrency connections"""
+    if stop.wait(delay):
+        return
+    remaining = iter(range(count))
+    lock = threading.Lock()
+
+    def worker():
+        client = Client(port)
+        while True:
+            with lock:
+                i = next(remaining, None)
+            if i is None or stop.is_set():
+                return
+            body = json.dumps({'username': f'bench{i % users}', 'password': PASSWORD})
+            started = time.perf_counter()
+            try:
+                status, data = client.request('POST', '/api/login', body, {'Content-Type': 'application/json'})
+            except (OSError, http.client.HTTPException):
+                return  # the run ended and took the server with it
+            recorder.record('POST /api/login', time.perf_counter() - started,
+                            status == 200 and json.loads(data).get('success'))
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    recorder.login_burst.set()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    recorder.login_burst.clear()
+
+
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(args, workdir, env):
+    if args.server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(args.port),
+                   '--log-level', 'warning', '--app-dir', APP_DIR]
+    else:
+        command = [sys.executable, os.path.join(APP_DIR, 'app.py')]
+    log_path = os.path.join(workdir, 'server.log')
+    with open(log_path, 'wb') as log:  # the dev server logs every request
+        server = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            with open(log_path, errors='replace') as log:
+                raise RuntimeError('Server exited: ' + log.read())
+        try:
+            Client(args.port).request('GET', '/api/check_login')
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('Server did not start')
+
+
+def summarize(recorder, duration):
+    endpoints = {}
+    for name, latencies in sorted(recorder.latencies.items()):
+        ordered = sorted(latencies)
+        endpoints[name] = {
+            'requests': len(ordered),
+            'errors': recorder.errors.get(name, 0),
+            'throughput': len(ordered) / duration,
+            'p50_ms': percentile(ordered, 0.50) * 1000,
+            'p95_ms': percentile(ordered, 0.95) * 1000,
+            'p99_ms': percentile(ordered, 0.99) * 1000,
+            'max_ms': ordered[-1] * 1000,
+        }
+    return endpoints
+
+
+def print_report(results, baseline=None):
+    print(f"{'endpoint':<48}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, stats in results['endpoints'].items():
+        print(f"{name:<48}{stats['throughput']:>10.1f}{stats['p50_ms']:>10.2f}"
+              f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['errors']:>8}")
+        before = (baseline or {}).get('endpoints', {}).get(name)
+        if before:
+            print(f"{'  vs baseline':<48}{stats['throughput'] - before['throughput']:>+10.1f}"
+                  f"{stats['p50_ms'] - before['p50_ms']:>+10.2f}{stats['p95_ms'] - before['p95_ms']:>+10.2f}"
+                  f"{stats['p99_ms'] - before['p99_ms']:>+10.2f}")
+    print(f"database: {results['db_bytes'] / 1e6:.1f} MB, server RSS: "
+          + (f"{results['rss_bytes'] / 1e6:.1f} MB" if results['rss_bytes'] else 'unknown'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pollers', type=int, default=50)
+    parser.add_argument('--posters', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load')
+    parser.add_argument('--poll-interval', type=float, default=2.0, help='the browser client polls every 2s')
+    parser.add_argument('--post-interval', type=float, default=0, help='0 posts back to back')
+    parser.add_argument('--image-ratio', type=float, default=0.1, help='fraction of posts that are images')
+    parser.add_argument('--image-size', type=int, default=64 * 1024)
+    parser.add_argument('--seed-users', type=int, default=100)
+    parser.add_argument('--seed-messages', type=int, default=100000)
+    parser.add_argument('--server', choices=['dev', 'asgi'], default='dev')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--login-burst', type=int, default=0, help='logins fired at once during the run')
+    parser.add_argument('--login-concurrency', type=int, default=100, help='connections the login burst uses')
+    parser.add_argument('--keep-limits', action='store_true', help='leave send rate limits at their defaults')
+    parser.add_argument('--output', help='results file (default bench-<time>.json)')
+    parser.add_argument('--compare', help='earlier results file to show differences against')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='chat-bench-')
+    database = os.path.join(workdir, 'bench.db')
+    env = dict(os.environ, CHAT_DATABASE=database, PORT=str(args.port), PYTHONPATH=APP_DIR)
+    if not args.keep_limits:
+        env.update(CHAT_SEND_RATE='1e9', CHAT_SEND_BURST='1000000000',
+                   CHAT_UPLOAD_RATE='1000000000000', CHAT_UPLOAD_BURST='1000000000000')
+
+    server = None
+    try:
+        print(f'Seeding {args.seed_users} users and {args.seed_messages} messages...')
+        subprocess.run([sys.executable, '-c', SEED_SCRIPT, str(args.seed_users), str(args.seed_messages), PASSWORD],
+                       cwd=workdir, env=env, check=True)
+        server = start_server(args, workdir, env)
+
+        recorder = Recorder()
+        stop = threading.Event()
+        threads = []
+        for i in range(args.pollers + args.posters):
+            client = Client(args.port)
+            client.login(f'bench{i % args.seed_users}')
+            if i < args.pollers:
+                target = (poller, (client, recorder, stop, args.poll_interval))
+            else:
+                target = (poster, (client, recorder, stop, args.post_interval, args.image_ratio, args.image_size))
+            threads.append(threading.Thread(target=target[0], args=target[1], daemon=True))
+        if args.login_burst:
+            threads.append(threading.Thread(target=login_burst, daemon=True, args=(
+                args.port, recorder, stop, args.duration / 3, args.login_burst, args.login_concurrency, args.seed_users)))
+
+        print(f'Running {args.pollers} pollers and {args.posters} posters for {args.duration:g}s...')
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        rss = rss_bytes(server.pid)
+        stop.set()
+        for thread in threads:
+            thread.join(30)
+        elapsed = time.perf_counter() - started
+
+        results = {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'config': vars(args),
+            'duration': elapsed,
+            'endpoints': summarize(recorder, elapsed),
+            'db_bytes': sum(os.path.getsize(database + suffix) for suffix in ('', '-wal')
+                            if os.path.exists(database + suffix)),
+            'rss_bytes': rss,
+        }
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    output = args.output or f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Image variant generation, run in worker processes.
+
+Kept apart from app.py so the work itself needs only Pillow. Spawned workers
+still re-run app.py when it is the main module; see VariantGenerator.submit.
+"""
+import os
+import tempfile
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+# Largest image decoded, in pixels. A 40 megapixel RGBA image needs 160 MB
+# before any copies are made; Pillow's own default allows over twice that.
+MAX_IMAGE_PIXELS = 40_000_000
+
+if Image is not None:
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+def variants_supported():
+    return Image is not None
+
+
+def output_format():
+    """WebP when Pillow was built with it, JPEG otherwise"""
+    if features.check('webp'):
+        return 'WEBP', 'image/webp', '.webp'
+    return 'JPEG', 'image/jpeg', '.jpg'
+
+
+def generate_variants(src_path, dest_dir, key, variants):
+    """Write downscaled copies of an image and describe them.
+
+    variants maps name -> (max width, max height, quality). Images are
+    re-encoded from pixels only, so EXIF and other metadata are dropped.
+    Animated images are left alone; images over MAX_IMAGE_PIXELS raise
+    ValueError before they are decoded. Returns a list of
+    (name, path, content_type, width, height, size).
+    """
+    image_format, content_type, ext = output_format()
+    results = []
+    with Image.open(src_path) as image:
+        if getattr(image, 'is_animated', False):
+            return results
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            raise ValueError(f'Image too large: {image.width}x{image.height}')
+        image = ImageOps.exif_transpose(image)
+        has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha and image_format == 'WEBP' else 'RGB')
+
+        os.makedirs(dest_dir, exist_ok=True)
+        for name, (max_width, max_height, quality) in variants.items():
+            variant = image.copy()
+            variant.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+            path = os.path.join(dest_dir, f'{key}.{name}{ext}')
+            fd, tmp_path = tempfile.mkstemp(dir=dest_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    variant.save(f, image_format, quality=quality)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            results.append((name, path, content_type, variant.width, variant.height, os.path.getsize(path)))
+    return results
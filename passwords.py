@@ -0,0 +1,56 @@
+"""Password hashing with salted, tunable key derivation.
+
+Hashes record their scheme and cost alongside the salt, so the cost can be
+raised later and older hashes still verify:
+
+    scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>
+    pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>
+
+A bare 64-character hex string is a legacy unsalted SHA-256 hash. The
+hashlib functions used here release the GIL while they run.
+"""
+import hashlib
+import hmac
+import secrets
+
+SALT_BYTES = 16
+SCRYPT_MAXMEM = 256 * 1024 * 1024
+
+
+def derive(password, scheme, params, salt):
+    if scheme == 'scrypt':
+        n, r, p = params
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=SCRYPT_MAXMEM, dklen=32)
+    if scheme == 'pbkdf2_sha256':
+        iterations, = params
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    raise ValueError(f'Unknown password scheme {scheme!r}')
+
+
+def hash_password(password, scheme, params):
+    salt = secrets.token_bytes(SALT_BYTES)
+    derived = derive(password, scheme, params, salt)
+    return '$'.join([scheme, *map(str, params), salt.hex(), derived.hex()])
+
+
+def parse(encoded):
+    """(scheme, params, salt, hash) of a stored hash"""
+    if '$' not in encoded:
+        return 'sha256', (), b'', bytes.fromhex(encoded)
+    scheme, *params, salt, derived = encoded.split('$')
+    return scheme, tuple(map(int, params)), bytes.fromhex(salt), bytes.fromhex(derived)
+
+
+def verify_password(password, encoded):
+    scheme, params, salt, expected = parse(encoded)
+    if scheme == 'sha256':
+        derived = hashlib.sha256(password.encode()).digest()
+    else:
+        derived = derive(password, scheme, params, salt)
+    return hmac.compare_digest(derived, expected)
+
+
+def needs_rehash(encoded, scheme, params):
+    """True if a hash was made with another scheme or cost than given"""
+    return parse(encoded)[:2] != (scheme, tuple(params))
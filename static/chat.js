@@ -0,0 +1,709 @@
+let currentMessageType = 'text';
+let currentUser = null;
+let isAdmin = false;
+
+// Message sync cursors: newest message id and newest deletion seen
+let lastMessageId = null;
+let deletionSeq = 0;
+let pollTimer = null;
+let eventSource = null;
+let loadInFlight = false;
+let loadPending = false;
+
+// Scroll-back: oldest message shown and whether older ones exist
+let oldestMessageId = null;
+let hasMoreHistory = true;
+let historyInFlight = false;
+
+// Feed rendering: pixels of rows kept in the DOM beyond the visible area,
+// and heights assumed for rows not yet measured
+const FEED_OVERSCAN = 800;
+const ESTIMATED_ROW_HEIGHT = 90;
+const ESTIMATED_IMAGE_ROW_HEIGHT = 400;
+
+// Check if user is logged in on page load
+window.onload = function() {
+    checkLoginStatus();
+};
+
+function startPolling() {
+    if (pollTimer || eventSource) return;
+    loadMessages();
+
+    if (!window.EventSource) {
+        pollTimer = setInterval(loadMessages, 2000); // Poll for new messages every 2 seconds
+        return;
+    }
+
+    // New messages are pushed; each (re)connect catches up through the cursor
+    eventSource = new EventSource('/api/stream');
+    eventSource.onopen = loadMessages;
+    eventSource.addEventListener('message', event => {
+        const message = JSON.parse(event.data);
+        // A sync that is missing or in flight may predate this message, so
+        // sync (again) instead; it fetches everything past the cursor
+        if (lastMessageId === null || loadInFlight) {
+            loadMessages();
+            return;
+        }
+        if (message.id <= lastMessageId) return;
+        feed.add([message], true);
+        lastMessageId = message.id;
+    });
+    eventSource.addEventListener('delete', event => {
+        const deletion = JSON.parse(event.data);
+        feed.applyDeletion(deletion);
+        if (lastMessageId === null || loadInFlight) {
+            // The reply in flight may still hold deleted messages; the next
+            // sync delivers this deletion again after it
+            loadMessages();
+            return;
+        }
+        deletionSeq = Math.max(deletionSeq, deletion.seq);
+    });
+    eventSource.onerror = () => {
+        // Fall back to polling if the stream is refused outright
+        if (eventSource.readyState === EventSource.CLOSED) {
+            eventSource = null;
+            pollTimer = setInterval(loadMessages, 2000);
+        }
+    };
+}
+
+function stopPolling() {
+    clearInterval(pollTimer);
+    pollTimer = null;
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+    }
+    lastMessageId = null;
+    deletionSeq = 0;
+    oldestMessageId = null;
+    hasMoreHistory = true;
+    feed.reset([]);
+}
+
+function checkLoginStatus() {
+    fetch('/api/check_login')
+        .then(response => response.json())
+        .then(data => {
+            if (data.logged_in) {
+                currentUser = data.username;
+                isAdmin = data.is_admin;
+                showChat();
+                startPolling();
+            }
+        });
+}
+
+function login(event) {
+    event.preventDefault();
+    const username = document.getElementById('loginUsername').value;
+    const password = document.getElementById('loginPassword').value;
+
+    fetch('/api/login', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({username, password})
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            currentUser = username;
+            isAdmin = data.is_admin;
+            showChat();
+            startPolling();
+        } else {
+            alert(data.message);
+        }
+    });
+}
+
+function register(event) {
+    event.preventDefault();
+    const username = document.getElementById('regUsername').value;
+    const email = document.getElementById('regEmail').value;
+    const password = document.getElementById('regPassword').value;
+
+    fetch('/api/register', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({username, email, password})
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            alert('Account created successfully! Please login.');
+            showLogin();
+        } else {
+            alert(data.message);
+        }
+    });
+}
+
+function logout() {
+    fetch('/api/logout', {method: 'POST'})
+        .then(() => {
+            currentUser = null;
+            isAdmin = false;
+            stopPolling();
+            showLogin();
+        });
+}
+
+function showLogin() {
+    document.getElementById('loginForm').classList.remove('hidden');
+    document.getElementById('registerForm').classList.add('hidden');
+    document.getElementById('chatInterface').classList.add('hidden');
+    document.getElementById('adminPanel').classList.add('hidden');
+}
+
+function showRegister() {
+    document.getElementById('loginForm').classList.add('hidden');
+    document.getElementById('registerForm').classList.remove('hidden');
+    document.getElementById('chatInterface').classList.add('hidden');
+    document.getElementById('adminPanel').classList.add('hidden');
+}
+
+function showChat() {
+    document.getElementById('loginForm').classList.add('hidden');
+    document.getElementById('registerForm').classList.add('hidden');
+    document.getElementById('chatInterface').classList.remove('hidden');
+    document.getElementById('adminPanel').classList.add('hidden');
+    document.getElementById('currentUser').textContent = currentUser;
+
+    if (isAdmin) {
+        document.getElementById('adminBtn').style.display = 'block';
+    }
+}
+
+function showAdmin() {
+    if (!isAdmin) return;
+    document.getElementById('adminPanel').classList.remove('hidden');
+    document.getElementById('chatInterface').classList.add('hidden');
+    loadAdminData();
+}
+
+function hideAdmin() {
+    document.getElementById('adminPanel').classList.add('hidden');
+    document.getElementById('chatInterface').classList.remove('hidden');
+}
+
+function setMessageType(type) {
+    currentMessageType = type;
+
+    // Update button states
+    document.querySelectorAll('.type-btn').forEach(btn => btn.classList.remove('active'));
+    event.target.classList.add('active');
+
+    // Show/hide relevant inputs
+    const messageInput = document.getElementById('messageInput');
+    const urlInput = document.getElementById('urlInput');
+    const fileBtn = document.getElementById('fileBtn');
+
+    messageInput.classList.add('hidden');
+    urlInput.classList.add('hidden');
+    fileBtn.classList.add('hidden');
+
+    if (type === 'text') {
+        messageInput.classList.remove('hidden');
+        messageInput.placeholder = 'Type your message...';
+    } else if (type === 'image') {
+        fileBtn.classList.remove('hidden');
+    } else if (type === 'text+image') {
+        messageInput.classList.remove('hidden');
+        fileBtn.classList.remove('hidden');
+        messageInput.placeholder = 'Type your message...';
+    } else if (type === 'url') {
+        messageInput.classList.remove('hidden');
+        urlInput.classList.remove('hidden');
+        messageInput.placeholder = 'Description (optional)...';
+    }
+}
+
+function sendMessage() {
+    const messageInput = document.getElementById('messageInput');
+    const urlInput = document.getElementById('urlInput');
+    const imageInput = document.getElementById('imageInput');
+
+    const formData = new FormData();
+    formData.append('message_type', currentMessageType);
+
+    if (currentMessageType === 'text') {
+        if (!messageInput.value.trim()) return;
+        formData.append('content', messageInput.value.trim());
+    } else if (currentMessageType === 'image') {
+        if (!imageInput.files[0]) return;
+        formData.append('image', imageInput.files[0]);
+    } else if (currentMessageType === 'text+image') {
+        if (!messageInput.value.trim() && !imageInput.files[0]) return;
+        formData.append('content', messageInput.value.trim());
+        if (imageInput.files[0]) {
+            formData.append('image', imageInput.files[0]);
+        }
+    } else if (currentMessageType === 'url') {
+        if (!urlInput.value.trim()) return;
+        formData.append('url', urlInput.value.trim());
+        formData.append('content', messageInput.value.trim());
+    }
+
+    fetch('/api/send_message', {
+        method: 'POST',
+        body: formData
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            messageInput.value = '';
+            urlInput.value = '';
+            imageInput.value = '';
+            loadMessages();
+        } else {
+            alert(data.message);
+        }
+    });
+}
+
+function loadMessages() {
+    // Only one sync request at a time; coalesce calls made meanwhile
+    if (loadInFlight) {
+        loadPending = true;
+        return;
+    }
+    loadInFlight = true;
+
+    let url = '/api/messages';
+    if (lastMessageId !== null) {
+        url += `?after_id=${lastMessageId}&deleted_after=${deletionSeq}`;
+    }
+
+    fetch(url)
+        .then(response => response.json())
+        .then(data => {
+            if (data.reset) {
+                feed.reset(data.messages);
+                oldestMessageId = data.messages.length ? data.messages[0].id : null;
+                hasMoreHistory = oldestMessageId !== null;
+            } else {
+                data.deletions.forEach(deletion => feed.applyDeletion(deletion));
+                feed.add(data.messages, true);  // Skips any it already has
+                if (oldestMessageId === null && data.messages.length) oldestMessageId = data.messages[0].id;
+            }
+
+            // Cursors only move forward
+            lastMessageId = lastMessageId === null ? data.last_id : Math.max(lastMessageId, data.last_id);
+            deletionSeq = Math.max(deletionSeq, data.deletion_seq);
+        })
+        .finally(() => {
+            loadInFlight = false;
+            if (loadPending) {
+                loadPending = false;
+                loadMessages();
+            }
+        });
+}
+
+function loadHistory() {
+    if (historyInFlight || !hasMoreHistory || oldestMessageId === null) return;
+    historyInFlight = true;
+
+    fetch(`/api/messages/history?before_id=${oldestMessageId}`)
+        .then(response => response.json())
+        .then(data => {
+            // The feed keeps the messages the user is reading where they were
+            feed.add(data.messages, false);
+            if (data.messages.length) oldestMessageId = data.messages[0].id;
+            hasMoreHistory = data.has_more;
+        })
+        .finally(() => {
+            historyInFlight = false;
+        });
+}
+
+function renderMessage(message) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message';
+    messageDiv.dataset.id = message.id;
+    messageDiv.dataset.username = message.username;
+
+    let messageContent = `
+        <div class="message-header">
+            <span class="username">${message.username}</span>
+            <span>${new Date(message.timestamp).toLocaleString()}</span>
+        </div>
+        <div class="message-content">
+    `;
+
+    if (message.content) {
+        messageContent += `<div>${message.content}</div>`;
+    }
+
+    if (message.image_url) {
+        messageContent += `<a href="${message.image_url}" target="_blank"><img data-src="${message.display_url}" class="message-image" alt="Image" loading="lazy" decoding="async"></a>`;
+    }
+
+    if (message.url) {
+        messageContent += `<a href="${message.url}" target="_blank" class="message-url">${message.url}</a>`;
+    }
+
+    messageContent += `</div>`;
+    messageDiv.innerHTML = messageContent;
+    messageDiv.querySelectorAll('img[data-src]').forEach(loadImageLazily);
+    return messageDiv;
+}
+
+// Browsers without loading="lazy" get images once they near the viewport
+const imageObserver = !('loading' in HTMLImageElement.prototype) && window.IntersectionObserver
+    ? new IntersectionObserver(entries => entries.forEach(entry => {
+        if (!entry.isIntersecting) return;
+        imageObserver.unobserve(entry.target);
+        entry.target.src = entry.target.dataset.src;
+    }), { rootMargin: '400px' })
+    : null;
+
+function loadImageLazily(img) {
+    if (imageObserver) {
+        imageObserver.observe(img);
+    } else {
+        img.src = img.dataset.src;
+    }
+}
+
+// target is 'id:username': that user's messages up to and including id
+function isUserBefore(message, target) {
+    const split = target.indexOf(':');
+    return message.id <= Number(target.slice(0, split)) && message.username === target.slice(split + 1);
+}
+
+function isDeleted(message, deletion) {
+    return deletion.scope === 'all' ||
+        (deletion.scope === 'user' && message.username === deletion.target) ||
+        (deletion.scope === 'before' && message.id <= Number(deletion.target)) ||
+        (deletion.scope === 'user_before' && isUserBefore(message, deletion.target));
+}
+
+// Renders the message list, keyed by message id. Only rows near the
+// viewport are in the DOM; two spacers stand in for the rest, sized from
+// measured heights, or estimates until a row has been shown. Changes patch
+// in added and removed rows only, leaving other nodes (and their decoded
+// images) alone. The row the reader is looking at stays put, unless they
+// are at the bottom, in which case the feed follows new messages.
+class MessageFeed {
+    constructor(container) {
+        this.container = container;
+        this.messages = [];  // Sorted by id
+        this.tops = [0];  // Offset of each row, then the total height
+        this.heights = new Map();  // id -> measured height, margin included
+        this.nodes = new Map();  // id -> mounted row
+        this.gap = null;
+        this.frame = null;
+        this.topSpacer = document.createElement('div');
+        this.bottomSpacer = document.createElement('div');
+        container.append(this.topSpacer, this.bottomSpacer);
+
+        // Rows change height as their images load or the window resizes
+        this.resizeObserver = window.ResizeObserver
+            ? new ResizeObserver(entries => this.measure(entries.map(entry => entry.target)))
+            : null;
+        container.addEventListener('scroll', () => this.schedule());
+        window.addEventListener('resize', () => this.schedule());
+    }
+
+    reset(messages) {
+        this.nodes.forEach(node => this.unmount(node));
+        this.nodes.clear();
+        this.heights.clear();
+        this.messages = messages.slice().sort((a, b) => a.id - b.id);
+        this.tops = null;
+        this.render(null, true);
+    }
+
+    // Add messages, new or older; live ones fade in if they are shown
+    add(messages, live) {
+        if (!messages.length) return;
+        const stick = this.atBottom();
+        const anchor = this.anchor();
+        const known = new Set(this.messages.map(message => message.id));
+        this.messages = this.messages.concat(messages.filter(message => !known.has(message.id)));
+        this.messages.sort((a, b) => a.id - b.id);
+        this.render(anchor, stick);
+        if (live) {
+            messages.forEach(message => {
+                const node = this.nodes.get(message.id);
+                if (node) node.classList.add('new');
+            });
+        }
+    }
+
+    applyDeletion(deletion) {
+        const stick = this.atBottom();
+        const anchor = this.anchor();
+        this.messages = this.messages.filter(message => {
+            if (!isDeleted(message, deletion)) return true;
+            this.heights.delete(message.id);
+            return false;
+        });
+        this.render(anchor, stick);
+    }
+
+    atBottom() {
+        const c = this.container;
+        return c.scrollHeight - c.scrollTop - c.clientHeight < 50;
+    }
+
+    // The first row in view and how far below the top of the view it starts
+    anchor() {
+        if (!this.tops) return null;
+        const scrollTop = this.container.scrollTop;
+        for (let i = 0; i < this.messages.length; i++) {
+            if (this.tops[i + 1] > scrollTop) {
+                return { id: this.messages[i].id, offset: this.tops[i] - scrollTop };
+            }
+        }
+        return null;
+    }
+
+    heightOf(message) {
+        return this.heights.get(message.id) ||
+            (message.image_url ? ESTIMATED_IMAGE_ROW_HEIGHT : ESTIMATED_ROW_HEIGHT);
+    }
+
+    layout() {
+        const tops = [0];
+        this.messages.forEach((message, i) => tops.push(tops[i] + this.heightOf(message)));
+        this.tops = tops;
+    }
+
+    // Scroll position that puts the anchor back where it was
+    scrollTarget(anchor, stick) {
+        if (stick) return Math.max(0, this.tops[this.messages.length] - this.container.clientHeight);
+        if (anchor) {
+            const index = this.messages.findIndex(message => message.id >= anchor.id);
+            if (index !== -1) return this.tops[index] - anchor.offset;
+        }
+        return this.container.scrollTop;
+    }
+
+    schedule() {
+        if (this.frame === null) {
+            this.frame = requestAnimationFrame(() => {
+                this.frame = null;
+                this.render(this.anchor(), false);
+            });
+        }
+    }
+
+    render(anchor, stick) {
+        const c = this.container;
+        this.layout();
+        const viewTop = this.scrollTarget(anchor, stick);
+        const count = this.messages.length;
+        let start = 0;
+        while (start < count && this.tops[start + 1] < viewTop - FEED_OVERSCAN) start++;
+        let end = start;
+        while (end < count && this.tops[end] < viewTop + c.clientHeight + FEED_OVERSCAN) end++;
+
+        const visible = new Set();
+        for (let i = start; i < end; i++) visible.add(this.messages[i].id);
+        this.nodes.forEach((node, id) => {
+            if (!visible.has(id)) {
+                this.unmount(node);
+                this.nodes.delete(id);
+            }
+        });
+
+        const mounted = [];
+        let previous = this.topSpacer;
+        for (let i = start; i < end; i++) {
+            const message = this.messages[i];
+            let node = this.nodes.get(message.id);
+            if (!node) {
+                node = renderMessage(message);
+                this.nodes.set(message.id, node);
+                if (this.resizeObserver) this.resizeObserver.observe(node);
+                else node.querySelectorAll('img').forEach(img => img.addEventListener('load', () => this.measure([node])));
+                mounted.push(node);
+            }
+            if (previous.nextSibling !== node) previous.after(node);
+            previous = node;
+        }
+
+        // Measure the new rows before placing the spacers and the scroll position
+        this.measure(mounted, false);
+        this.layout();
+        this.topSpacer.style.height = `${this.tops[start]}px`;
+        this.bottomSpacer.style.height = `${this.tops[count] - this.tops[end]}px`;
+        const target = stick ? c.scrollHeight : this.scrollTarget(anchor, stick);
+        if (Math.abs(c.scrollTop - target) >= 1) c.scrollTop = target;
+    }
+
+    // Record rows' heights; re-render if any changed
+    measure(nodes, rerender = true) {
+        let changed = false;
+        nodes.forEach(node => {
+            if (!node.isConnected) return;
+            if (this.gap === null) this.gap = parseFloat(getComputedStyle(node).marginBottom) || 0;
+            const id = Number(node.dataset.id);
+            if (!node.offsetHeight) return;  // Hidden, so not laid out
+            const height = node.offsetHeight + this.gap;
+            if (this.heights.get(id) !== height) {
+                this.heights.set(id, height);
+                changed = true;
+            }
+        });
+        if (changed && rerender) {
+            const stick = this.atBottom();
+            const anchor = this.anchor();
+            this.render(anchor, stick);
+        }
+    }
+
+    unmount(node) {
+        if (this.resizeObserver) this.resizeObserver.unobserve(node);
+        node.remove();
+    }
+}
+
+const feed = new MessageFeed(document.getElementById('messages'));
+
+function loadAdminData() {
+    // Load current settings
+    fetch('/api/admin/settings')
+        .then(response => response.json())
+        .then(data => {
+            document.getElementById('maxImageSize').value = Math.floor(data.max_image_size / 1024);
+            document.getElementById('retentionDays').value = data.retention_days;
+            document.getElementById('retentionMaxMessages').value = data.retention_max_messages;
+            document.getElementById('retentionMaxSize').value = Math.floor(data.retention_max_bytes / (1024 * 1024));
+            document.getElementById('retentionArchive').checked = data.retention_archive === 1;
+        });
+
+    // Load users
+    fetch('/api/admin/users')
+        .then(response => response.json())
+        .then(data => {
+            const usersList = document.getElementById('usersList');
+            usersList.innerHTML = '';
+
+            data.users.forEach(user => {
+                const userDiv = document.createElement('div');
+                userDiv.className = 'user-item';
+                userDiv.innerHTML = `
+                    <span>${user.username} (${user.email || 'No email'}) ${user.is_banned ? '[BANNED]' : ''}</span>
+                    <div class="user-actions">
+                        <button onclick="toggleBan(${user.id}, ${user.is_banned})" class="btn-warning">
+                            ${user.is_banned ? 'Unban' : 'Ban'}
+                        </button>
+                        <button onclick="deleteUser(${user.id})" class="btn-danger">Delete</button>
+                    </div>
+                `;
+                usersList.appendChild(userDiv);
+            });
+        });
+}
+
+function updateSettings() {
+    const maxImageSize = document.getElementById('maxImageSize').value * 1024;
+
+    fetch('/api/admin/update_settings', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({
+            max_image_size: maxImageSize,
+            retention_days: Number(document.getElementById('retentionDays').value),
+            retention_max_messages: Number(document.getElementById('retentionMaxMessages').value),
+            retention_max_bytes: document.getElementById('retentionMaxSize').value * 1024 * 1024,
+            retention_archive: document.getElementById('retentionArchive').checked ? 1 : 0
+        })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            alert('Settings updated successfully!');
+        } else {
+            alert('Error updating settings');
+        }
+    });
+}
+
+function toggleBan(userId, isBanned) {
+    fetch('/api/admin/toggle_ban', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({user_id: userId, ban: !isBanned})
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            loadAdminData();
+        } else {
+            alert('Error updating user status');
+        }
+    });
+}
+
+function deleteUser(userId) {
+    if (confirm('Are you sure you want to delete this user?')) {
+        fetch('/api/admin/delete_user', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({user_id: userId})
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.success) {
+                watchPurge(data.job, () => loadAdminData());
+            } else {
+                alert('Error deleting user');
+            }
+        });
+    }
+}
+
+function deleteAllMessages() {
+    if (confirm('Are you sure you want to delete ALL messages? This cannot be undone!')) {
+        fetch('/api/admin/delete_all_messages', {
+            method: 'POST'
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.success) {
+                watchPurge(data.job, job => {
+                    alert(`Deleted ${job.deleted} messages`);
+                    loadMessages();
+                });
+            } else {
+                alert('Error deleting messages');
+            }
+        });
+    }
+}
+
+// Poll a background purge until it finishes
+function watchPurge(job, onDone) {
+    if (job.status !== 'running') {
+        if (job.status === 'failed') alert(`Deletion failed: ${job.error}`);
+        onDone(job);
+        return;
+    }
+    setTimeout(() => {
+        fetch(`/api/admin/purges/${job.id}`)
+            .then(response => response.json())
+            .then(data => watchPurge(data.job, onDone));
+    }, 1000);
+}
+
+// Fetch older messages when scrolled near the top
+document.getElementById('messages').addEventListener('scroll', event => {
+    if (event.target.scrollTop < 100) {
+        loadHistory();
+    }
+});
+
+// Allow Enter key to send messages
+document.addEventListener('keypress', function(e) {
+    if (e.key === 'Enter' && (e.target.id === 'messageInput' || e.target.id === 'urlInput')) {
+        sendMessage();
+    }
+});